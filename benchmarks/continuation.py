@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Compare the per-generation overhead of the two continuation modes.
+
+The `guamps` mode rewrites positions, velocities, and time into the
+.tpr before each generation and extracts them from the .trr after it.
+The `checkpoint` mode instead restores `mdrun` from the checkpoint,
+writes the next one, and renames the `.part` outputs of the
+continuation.  This runs the worker-side commands of both modes on real
+inputs and reports their cost next to the files each mode moves between
+generations.  The checkpoint mode is only measured when a checkpoint is
+given: its restore cost is the time of a zero-step `mdrun -cpi` beyond
+that of a zero-step `mdrun` of the same .tpr.
+
+usage: continuation.py TPR TRR [CPT] [-n REPEATS] [--mdrun MDRUN]
+The guamps_get, guamps_set, and mdrun binaries must be in the PATH.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SELECTIONS = ['positions', 'velocities', 'time']
+
+
+def getopts():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('tpr')
+    p.add_argument('trr')
+    p.add_argument('cpt', nargs='?', help='A checkpoint of the same system, to measure the checkpoint mode')
+    p.add_argument('-n', '--repeats', type=int, default=5)
+    p.add_argument('--mdrun', default='mdrun', help='The mdrun binary')
+    return p.parse_args()
+
+def timed(cmd, cwd=None):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, cwd=cwd, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+def guamps_generation(workdir, tpr, trr):
+    """Run the guamps commands of one generation, returning (get seconds, set seconds, gps bytes)"""
+    gps = dict((sel, os.path.join(workdir, sel + '.gps')) for sel in SELECTIONS)
+    t_get = sum(timed(['guamps_get', '-f', trr, '-s', sel, '-o', gps[sel]]) for sel in SELECTIONS)
+    t_set = sum(timed(['guamps_set', '-f', tpr, '-s', sel, '-i', gps[sel]]) for sel in SELECTIONS)
+    size  = sum(os.path.getsize(path) for path in gps.values())
+    return t_get, t_set, size
+
+def checkpoint_generation(workdir, tpr, cpt, mdrun):
+    """Run the checkpoint commands of one generation, returning (restore seconds, rename seconds)"""
+    run = [mdrun, '-nt', '1', '-s', tpr, '-nsteps', '0', '-cpo', 'state.cpt']
+    t_base    = timed(run, cwd=workdir)
+    t_restore = timed(run + ['-cpi', cpt, '-noappend'], cwd=workdir)
+
+    # the renaming done by the md_cpt.sh script
+    start = time.time()
+    for path in glob.glob(os.path.join(workdir, '*.part[0-9][0-9][0-9][0-9].*')):
+        name, part, ext = os.path.basename(path).rsplit('.', 2)
+        os.rename(path, os.path.join(workdir, name + '.' + ext))
+    t_rename = time.time() - start
+
+    return t_restore - t_base, t_rename
+
+def main():
+    opts = getopts()
+    os.environ['GMX_MAXBACKUP'] = '-1' # as in the worker scripts
+    workdir = tempfile.mkdtemp(prefix='mdq-bench-')
+    try:
+        tpr = os.path.join(workdir, 'topol.tpr')
+        cpt = os.path.join(workdir, 'input.cpt')
+        gets, sets, restores, renames = list(), list(), list(), list()
+        for _ in xrange(opts.repeats):
+            shutil.copy(opts.tpr, tpr)
+            t_get, t_set, gps_bytes = guamps_generation(workdir, tpr, opts.trr)
+            gets.append(t_get)
+            sets.append(t_set)
+            if opts.cpt:
+                shutil.copy(opts.cpt, cpt)
+                t_restore, t_rename = checkpoint_generation(workdir, tpr, cpt, opts.mdrun)
+                restores.append(t_restore)
+                renames.append(t_rename)
+    finally:
+        shutil.rmtree(workdir)
+
+    mean = lambda xs: sum(xs) / len(xs)
+    print '{:<12s} {:>12s} {:>12s} {:>12s} {:>14s}'.format('mode', 'set (s)', 'get (s)', 'total (s)', 'state (bytes)')
+    print '{:<12s} {:>12.3f} {:>12.3f} {:>12.3f} {:>14d}'.format(
+        'guamps', mean(sets), mean(gets), mean(sets) + mean(gets), gps_bytes)
+    if opts.cpt:
+        # setting the state is restoring the checkpoint, getting it is renaming the outputs
+        print '{:<12s} {:>12.3f} {:>12.3f} {:>12.3f} {:>14d}'.format(
+            'checkpoint', mean(restores), mean(renames), mean(restores) + mean(renames),
+            os.path.getsize(opts.cpt))
+    else:
+        print '{:<12s} {:>12s} {:>12s} {:>12s} {:>14s}'.format(
+            'checkpoint', '-', '-', '-', '-')
+        print 'the checkpoint mode is not measured without a checkpoint'
+
+if __name__ == '__main__':
+    main()
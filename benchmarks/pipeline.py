@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Measure the throughput of the master pipeline as the number of simulations grows.
+
+The pipeline of `mdq run` (Fount -> ResumeTaskStream ->
+GenerationalWorkQueueStream -> Sink) runs over gromacs tasks whose
+outputs are produced without running any simulation:
+
+  fake : an in-process executor writes the expected outputs of each
+         task as soon as it is waited for, so only the master is measured
+  local: the LocalExecutor runs each task with stub mdrun and guamps
+         scripts, to check the whole pipeline on a single machine
+
+Each size runs in its own process, which reports the tasks completed
+per second, the cost of committing completed tasks to the state store,
+and its maximum resident memory.
+
+Neither executor needs CCTools, and with `--check` the exit status is
+non-zero unless every generation of every simulation completed, so a
+small local run serves as a smoke test of `mdq run`:
+
+  pipeline.py --executor local -n 4 --check
+
+usage: pipeline.py [-n SIMS [SIMS ...]] [-g GENERATIONS] [--executor fake|local] [--check]
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+STUBS = dict(
+    mdrun = """\
+#!/usr/bin/env bash
+for f in traj.trr traj.xtc ener.edr; do echo $f > $f; done
+cat > md.log <<EOF
+           Step           Time         Lambda
+           1000        2.00000        0.00000
+
+               (ns/day)    (hour/ns)
+Performance:    100.000      0.240
+EOF
+""",
+    guamps_get = """\
+#!/usr/bin/env bash
+# guamps_get -f FILE -s SELECTION -o OUTPUT
+# the time must advance for the generation to be valid
+date +%s.%N > $6
+""",
+    guamps_set = """\
+#!/usr/bin/env bash
+true
+""",
+    )
+
+
+def getopts():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('-n', '--sims', type=int, nargs='+', default=[10**2, 10**3, 10**4, 10**5])
+    p.add_argument('-g', '--generations', type=int, default=2)
+    p.add_argument('-e', '--executor', choices=['fake', 'local'], default='fake')
+    p.add_argument('-w', '--workers', type=int, default=4, help='Workers of the local executor')
+    p.add_argument('-B', '--persist-batch', type=int, default=32)
+    p.add_argument('--threaded', action='store_true')
+    p.add_argument('--check', action='store_true', help='Fail unless all the generations completed')
+    p.add_argument('--size', type=int, help=argparse.SUPPRESS) # run a single size in this process
+    return p.parse_args()
+
+
+class FakeStats(object):
+    total_workers_connected = 1
+    tasks_waiting = 0
+
+class FakeResult(object):
+    def __init__(self, taskid, task):
+        self.id                      = taskid
+        self.uuid                    = task.uuid
+        self.result                  = 0
+        self.return_status           = 0
+        self.hostname                = 'fake'
+        self.cmd_execution_time      = 0
+        self.total_transfer_time     = 0
+        self.total_bytes_transferred = 0
+
+def mk_fake_executor():
+    from mdq.executor import Executor
+    import collections
+
+    class FakeExecutor(Executor):
+        """Completes tasks in order of submission by writing their outputs"""
+
+        def __init__(self):
+            self._tasks = collections.OrderedDict()
+            self._ids   = 0
+
+        @property
+        def stats(self): return FakeStats()
+
+        def submit(self, task):
+            self._ids += 1
+            self._tasks[self._ids] = task
+            return self._ids
+
+        def wait(self, timeout):
+            if not self._tasks: return None
+            taskid, task = self._tasks.popitem(last=False)
+            # task ids increase, so the time of each generation advances
+            for local, _, _, _ in task.outputs:
+                with open(local, 'w') as fd: fd.write('%d\n' % taskid)
+            return FakeResult(taskid, task)
+
+        def cancel(self, taskid):
+            self._tasks.pop(taskid, None)
+
+        def blacklist(self, host):
+            pass
+
+    return FakeExecutor()
+
+def setup(root, sims):
+    """Create the state of `sims` simulations under `root`, returning the path to the state store"""
+    from mdq.md import gmx
+    from mdq.persistence import Store
+
+    bindir = os.path.join(root, 'binaries', platform.system(), platform.machine())
+    os.makedirs(bindir)
+    for name, contents in STUBS.iteritems():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as fd: fd.write(contents)
+        os.chmod(path, 0755)
+
+    tpr = os.path.join(root, 'topol.tpr')
+    with open(tpr, 'w') as fd: fd.write('tpr\n')
+
+    path  = os.path.join(root, 'state.sqlite')
+    store = Store(path, batch=1000)
+    for i in xrange(sims):
+        outdir = os.path.join(root, 'sims', str(i))
+        gendir = os.path.join(outdir, '0')
+        os.makedirs(gendir)
+        gps = dict()
+        for key in 'xvt':
+            gps[key] = os.path.join(gendir, gmx.SCRIPT_INPUT_NAMES[key])
+            with open(gps[key], 'w') as fd: fd.write('0\n')
+        task = gmx.Task(x=gps['x'], v=gps['v'], t=gps['t'], tpr=tpr, outputdir=outdir,
+                        cpus=1, digest='%064x' % i)
+        for name in gmx.EXECUTABLES:
+            task.add_binary(os.path.join(root, 'binaries', '$OS', '$ARCH', name))
+        task.keep_log()
+        store[task.digest] = task
+    store.close()
+    return path
+
+def run(opts, sims):
+    from mdq import metrics
+    from mdq.executor import LocalExecutor
+    from mdq.persistence import Store
+    from mdq.scripts.run import TaskFount
+    from mdq.stream import ResumeTaskStream, GenerationalWorkQueueStream, Sink
+    from pxul import logging as log
+
+    log.set_info()
+
+    root = tempfile.mkdtemp(prefix='mdq-bench-')
+    try:
+        path  = setup(root, sims)
+        store = Store(path, batch=opts.persist_batch)
+        q = mk_fake_executor() if opts.executor == 'fake' else LocalExecutor(workers=opts.workers)
+
+        fount = TaskFount()
+        fount.set_state(store)
+        submit = GenerationalWorkQueueStream(q, ResumeTaskStream(fount, store), timeout=0.01,
+                                             persist_to=store, persist_batch=opts.persist_batch,
+                                             threaded=opts.threaded, generations=opts.generations)
+        start = time.time()
+        Sink(submit)()
+        elapsed = time.time() - start
+        q.shutdown()
+        store.close()
+
+        snapshot = metrics.registry.snapshot()['metrics']
+        persist  = snapshot['persist_seconds']
+        return dict(
+            sims          = sims,
+            tasks         = snapshot['tasks_completed']['value'],
+            seconds       = elapsed,
+            tasks_per_sec = snapshot['tasks_completed']['value'] / elapsed,
+            persist_sec   = persist['sum'],
+            persist_share = persist['sum'] / elapsed,
+            maxrss_mb     = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    opts = getopts()
+    if opts.size is not None:
+        print json.dumps(run(opts, opts.size))
+        return
+
+    print '{:>8s} {:>9s} {:>10s} {:>10s} {:>12s} {:>9s} {:>11s}'.format(
+        'sims', 'tasks', 'time (s)', 'tasks/s', 'persist (s)', 'persist%', 'maxrss (MB)')
+    failed = list()
+    for sims in opts.sims:
+        args = [sys.executable, os.path.abspath(__file__), '--size', str(sims)] + sys.argv[1:]
+        out  = subprocess.check_output(args)
+        r    = json.loads(out.strip().splitlines()[-1])
+        print '{:>8d} {:>9d} {:>10.2f} {:>10.1f} {:>12.3f} {:>8.1f}% {:>11.1f}'.format(
+            r['sims'], r['tasks'], r['seconds'], r['tasks_per_sec'],
+            r['persist_sec'], 100 * r['persist_share'], r['maxrss_mb'])
+        sys.stdout.flush()
+        if r['tasks'] != sims * opts.generations:
+            failed.append(sims)
+
+    if opts.check and failed:
+        sys.exit('Not all generations completed for %s simulations' % ', '.join(map(str, failed)))
+
+if __name__ == '__main__':
+    main()
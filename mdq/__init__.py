@@ -1 +1,5 @@
-from .workqueue import *
+try:
+    from .workqueue import *
+except ImportError:
+    # Work Queue (CCTools) is only needed to run tasks on workers, see mdq.executor
+    pass
@@ -0,0 +1,124 @@
+"""
+Content digests of files.
+
+Hashing is streamed so that large files are never held in memory, and
+`DigestCache` remembers the digest of each file keyed on its path,
+size, modification time and inode so that unchanged files are not
+rehashed.
+"""
+
+from .persistence import Store
+
+from pxul.logging import logger
+
+from multiprocessing.pool import ThreadPool
+import hashlib
+import os
+
+BLOCKSIZE = 4 * 1024 * 1024
+ALGORITHM = 'sha256'
+
+
+def hash_file(hasher, path, size=BLOCKSIZE):
+    """
+    Hash the contents of the file given by `path`, reading at most `size` bytes at a time
+    """
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(size)
+            if data == '': break
+            hasher.update(data)
+
+def file_digest(path, algorithm=ALGORITHM):
+    """
+    Return the hexdigest of the contents of the file at `path`
+    """
+    h = hashlib.new(algorithm)
+    hash_file(h, path)
+    return h.hexdigest()
+
+
+class DigestCache(object):
+    """
+    Cache of file digests.
+
+    If `path` is given the cache is persisted there, otherwise it only
+    lives in memory.  An entry is only used if the size, modification
+    time and inode of the file are unchanged.
+    """
+
+    def __init__(self, path=None, algorithm=ALGORITHM):
+        self._store     = Store(path) if path is not None else dict()
+        self._algorithm = algorithm
+        self._hits      = 0
+        self._misses    = 0
+
+    @staticmethod
+    def _fingerprint(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime, st.st_ino
+
+    def _lookup(self, key, fingerprint):
+        entry = self._store.get(key)
+        if entry is not None and entry[:3] == fingerprint:
+            return entry[3]
+
+    def digest(self, path):
+        """
+        Return the hexdigest of the file at `path`
+        """
+        return self.digests([path])[path]
+
+    def digests(self, paths, jobs=1):
+        """
+        Return a dict mapping each of `paths` to its hexdigest.
+        Files not in the cache are hashed using up to `jobs` threads.
+        """
+        result  = dict()
+        missing = list()
+        for path in paths:
+            key = os.path.abspath(path)
+            fp  = self._fingerprint(path)
+            h   = self._lookup(key, fp)
+            if h is None:
+                missing.append((path, key, fp))
+            else:
+                logger.debug('Cached digest', h, 'for', path)
+                result[path] = h
+
+        self._hits   += len(result)
+        self._misses += len(missing)
+        if not missing:
+            return result
+
+        def compute(item):
+            return file_digest(item[0], algorithm=self._algorithm)
+
+        if jobs > 1 and len(missing) > 1:
+            pool = ThreadPool(min(jobs, len(missing)))
+            try:
+                hashes = pool.map(compute, missing)
+            finally:
+                pool.close()
+        else:
+            hashes = map(compute, missing)
+
+        for (path, key, fp), h in zip(missing, hashes):
+            logger.debug('Computed digest', h, 'for', path)
+            self._store[key] = fp + (h,)
+            result[path] = h
+        self.sync()
+        return result
+
+    @property
+    def stats(self):
+        """(hits, misses) since the cache was opened"""
+        return self._hits, self._misses
+
+    def sync(self):
+        if hasattr(self._store, 'sync'):
+            self._store.sync()
+
+    def close(self):
+        if hasattr(self._store, 'close'):
+            self._store.close()
@@ -0,0 +1,413 @@
+"""
+Executors run the tasks created by `Taskable.to_task`.
+
+A `Task` records the command and the files of a task independently of
+where it will run.  An `Executor` accepts tasks with `submit`, returns
+them as results with `wait`, and may `cancel` them:
+
+  WorkQueueExecutor: runs tasks on Work Queue workers
+  LocalExecutor    : runs tasks as processes in sandboxes on this machine
+
+Results carry the attributes of Work Queue tasks that mdq uses (`uuid`,
+`result`, `return_status`, `hostname`, and the timings in microseconds),
+so the rest of mdq does not depend on the executor.
+"""
+
+from pxul.logging import logger
+
+import Queue
+import errno
+import itertools
+import multiprocessing
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+
+# values of `result`, as for Work Queue
+RESULT_SUCCESS        = 0
+RESULT_INPUT_MISSING  = 1
+RESULT_OUTPUT_MISSING = 2
+RESULT_UNKNOWN        = 64
+
+
+class Task(object):
+    """
+    A command with the files to transfer to and from its sandbox
+    """
+
+    def __init__(self, command):
+        self._uuid    = uuid.uuid1()
+        self.command  = command
+        self.buffers  = list() # (contents, remote, cache)
+        self.inputs   = list() # (local, remote, cache, name)
+        self.outputs  = list() # (local, remote, cache, name)
+        self.preferred_host = None
+        self.resources = dict() # cores, memory (MB), disk (MB)
+
+    @property
+    def uuid(self): return str(self._uuid)
+
+    def specify_buffer(self, buffer, remote, cache=True):
+        self.buffers.append((buffer, remote, cache))
+
+    def specify_input_file(self, local, remote=None, cache=True, name=None):
+        self.inputs.append((local, remote or os.path.basename(local), cache, name))
+
+    def specify_output_file(self, local, remote=None, cache=True, name=None):
+        self.outputs.append((local, remote or os.path.basename(local), cache, name))
+
+    def specify_preferred_host(self, host):
+        self.preferred_host = host
+
+    def specify_cores(self, cores):
+        self.resources['cores'] = cores
+
+    def specify_memory(self, memory):
+        self.resources['memory'] = memory
+
+    def specify_disk(self, disk):
+        self.resources['disk'] = disk
+
+    def cached(self):
+        """
+        Return the (remote name, bytes) of the inputs to be cached on the
+        worker.  Files naming $OS or $ARCH are sized for this machine.
+        """
+        files = [(remote, len(buffer)) for buffer, remote, cache in self.buffers if cache]
+        for local, remote, cache, _ in self.inputs:
+            if not cache: continue
+            local = expand(local)
+            files.append((remote, os.path.getsize(local) if os.path.exists(local) else 0))
+        return files
+
+    def __str__(self):
+        lines = ['command: %s' % self.command]
+        lines.extend('buffer: %s' % remote for _, remote, _ in self.buffers)
+        lines.extend('input: %s -> %s' % (local, remote) for local, remote, _, _ in self.inputs)
+        lines.extend('output: %s <- %s' % (local, remote) for local, remote, _, _ in self.outputs)
+        if self.preferred_host:
+            lines.append('preferred host: %s' % self.preferred_host)
+        lines.extend('%s: %s' % item for item in sorted(self.resources.iteritems()))
+        return '\n'.join(lines)
+
+
+def expand(path, env=dict(OS=platform.system(), ARCH=platform.machine())):
+    """
+    Replace $OS and $ARCH in `path` as a worker on this machine would
+    """
+    for name, value in env.iteritems():
+        path = path.replace('$' + name, value)
+    return path
+
+
+def ensure_dir(path):
+    """
+    Create directory `path` unless it exists, as may several tasks at once
+    """
+    if not path: return
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST: raise
+
+
+class Executor(object):
+
+    # whether the workers keep the cached inputs of a task for the next ones
+    supports_locality = False
+
+    @property
+    def stats(self):
+        """
+        An object with at least the `total_workers_connected` and `tasks_waiting` attributes
+        """
+        raise NotImplemented
+
+    def submit(self, task):
+        """Submit a `Task`, returning its task id"""
+        raise NotImplemented
+
+    def wait(self, timeout):
+        """Return the result of a completed task, or None after `timeout` seconds"""
+        raise NotImplemented
+
+    def cancel(self, taskid):
+        """Cancel the task with the id returned by `submit`"""
+        raise NotImplemented
+
+    def blacklist(self, host):
+        """Stop running tasks on the worker `host`"""
+        raise NotImplemented
+
+    def shutdown(self):
+        pass
+
+
+class Result(object):
+    """
+    The result of the `Task` run by a Work Queue task: the attributes of
+    the Work Queue task, but the `uuid` of the `Task`
+    """
+
+    def __init__(self, task, result):
+        self._task   = task
+        self._result = result
+
+    @property
+    def uuid(self): return self._task.uuid
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+
+
+class WorkQueueExecutor(Executor):
+    """
+    Run tasks on the workers of a Work Queue master `q` (eg from `MkWorkQueue`)
+    """
+
+    supports_locality = True
+
+    def __init__(self, q):
+        self._q     = q
+        self._tasks = dict() # Work Queue task uuid -> (task id, Task)
+        self._uuids = dict() # task id -> Work Queue task uuid
+
+    @property
+    def stats(self): return self._q.stats
+
+    def submit(self, task):
+        # imported here so that the other executors do not need CCTools
+        from . import workqueue as wq
+        t = wq.Task(task.command)
+        for buffer, remote, cache in task.buffers:
+            t.specify_buffer(buffer, remote, cache=cache)
+        for local, remote, cache, name in task.inputs:
+            kws = dict(name=name) if name else dict()
+            t.specify_input_file(local, remote, cache=cache, **kws)
+        for local, remote, cache, name in task.outputs:
+            kws = dict(name=name) if name else dict()
+            t.specify_output_file(local, remote, cache=cache, **kws)
+        if task.preferred_host:
+            t.specify_preferred_host(task.preferred_host)
+        for name, value in task.resources.iteritems():
+            getattr(t, 'specify_' + name)(value)
+        taskid = self._q.submit(t)
+        self._tasks[t.uuid] = (taskid, task)
+        self._uuids[taskid] = t.uuid
+        return taskid
+
+    def wait(self, timeout):
+        result = self._q.wait(timeout)
+        if result:
+            taskid, task = self._tasks.pop(result.uuid)
+            del self._uuids[taskid]
+            return Result(task, result)
+
+    def cancel(self, taskid):
+        self._q.cancel_by_taskid(taskid)
+        self._tasks.pop(self._uuids.pop(taskid), None)
+
+    def blacklist(self, host):
+        self._q.blacklist(host)
+
+
+class LocalStats(object):
+    def __init__(self, executor):
+        self._executor = executor
+
+    @property
+    def total_workers_connected(self): return self._executor.workers
+
+    @property
+    def tasks_waiting(self): return self._executor._pending.qsize()
+
+    @property
+    def total_cores(self):
+        # more cores than the machine has are committed when oversubscribed
+        return max(self._executor.cores, self._executor._committed)
+
+    @property
+    def committed_cores(self): return self._executor._committed
+
+
+class LocalResult(object):
+    """
+    The outcome of a task run by a `LocalExecutor`, with the attributes of a Work Queue task
+    """
+
+    def __init__(self, taskid, task):
+        self.id                      = taskid
+        self.uuid                    = task.uuid
+        self.command                 = task.command
+        self.result                  = RESULT_SUCCESS
+        self.return_status           = None
+        self.output                  = ''
+        self.hostname                = socket.gethostname()
+        self.submit_time             = None # microseconds since the epoch
+        self.finish_time             = None
+        self.cmd_execution_time      = None # microseconds
+        self.total_transfer_time     = 0
+        self.total_bytes_transferred = 0
+
+
+class LocalExecutor(Executor):
+    """
+    Run up to `workers` tasks at once as processes on this machine.
+
+    Each task runs in its own sandbox under `root` (a temporary
+    directory by default), where its buffers and input files are
+    written.  As on a worker, $OS and $ARCH in the names of local
+    input files are replaced by those of this machine, and $CORES is
+    set to the cores declared by the task (by default an even share of
+    the `cores` of this machine).  Sandboxes are removed once the
+    outputs are copied back, unless `keep`.
+    """
+
+    def __init__(self, workers=1, root=None, keep=False, cores=None):
+        self.workers   = workers
+        self.cores     = cores or multiprocessing.cpu_count()
+        self._committed = 0            # cores of the running tasks
+        self._root     = root or tempfile.mkdtemp(prefix='mdq-local-')
+        self._keep     = keep
+        self._ids      = itertools.count(1)
+        self._pending  = Queue.Queue() # (taskid, Task, submit time)
+        self._results  = Queue.Queue() # LocalResult
+        self._running  = dict()        # taskid -> subprocess.Popen
+        self._cancelled = set()
+        self._lock     = threading.Lock()
+        self._threads  = list()
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name='mdq-local-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info('Running tasks locally with', workers, 'workers in', self._root)
+
+    @property
+    def stats(self): return LocalStats(self)
+
+    def submit(self, task):
+        taskid = next(self._ids)
+        self._pending.put((taskid, task, time.time()))
+        return taskid
+
+    def wait(self, timeout):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            remaining = deadline - time.time()
+            try:
+                result = self._results.get(timeout=remaining) if remaining > 0 else self._results.get_nowait()
+            except Queue.Empty:
+                return None
+            with self._lock:
+                if result.id in self._cancelled:
+                    # cancelled after it was started
+                    self._cancelled.discard(result.id)
+                    continue
+            return result
+
+    def cancel(self, taskid):
+        with self._lock:
+            self._cancelled.add(taskid)
+            process = self._running.get(taskid)
+        if process is not None and process.poll() is None:
+            # the command runs in its own process group, so its children (eg mdrun) are killed too
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError, e:
+                if e.errno != errno.ESRCH: raise
+
+    def blacklist(self, host):
+        # this machine is the only worker
+        logger.warning('Not blacklisting', host, 'as tasks only run locally')
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._pending.put(None)
+        for thread in self._threads:
+            thread.join()
+        if not self._keep:
+            shutil.rmtree(self._root, ignore_errors=True)
+
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None: break
+            taskid, task, submitted = item
+            with self._lock:
+                if taskid in self._cancelled:
+                    self._cancelled.discard(taskid)
+                    continue
+            try:
+                result = self._run(taskid, task, submitted)
+            except Exception, e:
+                # the stream waits for a result of every task
+                logger.error('Failed to run task', task.uuid, ':', e)
+                result = LocalResult(taskid, task)
+                result.result = RESULT_UNKNOWN
+                result.submit_time = int(submitted * 1e6)
+                result.finish_time = int(time.time() * 1e6)
+            self._results.put(result)
+
+    def _run(self, taskid, task, submitted):
+        result = LocalResult(taskid, task)
+        result.submit_time = int(submitted * 1e6)
+        sandbox = os.path.join(self._root, str(taskid))
+        os.makedirs(sandbox)
+        try:
+            start = time.time()
+            for buffer, remote, _ in task.buffers:
+                with open(os.path.join(sandbox, remote), 'w') as fd:
+                    fd.write(buffer)
+            for local, remote, _, _ in task.inputs:
+                local = expand(local)
+                if not os.path.exists(local):
+                    logger.error('Missing input', local, 'of task', task.uuid)
+                    result.result = RESULT_INPUT_MISSING
+                    return result
+                shutil.copy(local, os.path.join(sandbox, remote))
+                result.total_bytes_transferred += os.path.getsize(local)
+            transfer = time.time() - start
+
+            cores = task.resources.get('cores') or max(1, self.cores // self.workers)
+            env = dict(os.environ, CORES=str(cores))
+
+            start = time.time()
+            process = subprocess.Popen(task.command, shell=True, cwd=sandbox, executable='/bin/bash', env=env,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+            with self._lock:
+                self._running[taskid] = process
+                self._committed += cores
+            try:
+                result.output = process.communicate()[0]
+            finally:
+                with self._lock:
+                    del self._running[taskid]
+                    self._committed -= cores
+            result.return_status = process.returncode
+            result.cmd_execution_time = int((time.time() - start) * 1e6)
+
+            start = time.time()
+            for local, remote, _, _ in task.outputs:
+                path = os.path.join(sandbox, remote)
+                if not os.path.exists(path):
+                    result.result = RESULT_OUTPUT_MISSING
+                    continue
+                ensure_dir(os.path.dirname(local))
+                shutil.copy(path, local)
+                result.total_bytes_transferred += os.path.getsize(path)
+            transfer += time.time() - start
+            result.total_transfer_time = int(transfer * 1e6)
+            result.finish_time = int(time.time() * 1e6)
+            return result
+        finally:
+            if not self._keep:
+                shutil.rmtree(sandbox, ignore_errors=True)
@@ -1,8 +1,21 @@
 
 
-from .. import workqueue
+class Taskable(object):
+    """
+    Tasks implementing the `Taskable` interface are run by an `mdq.executor.Executor`.
+    """
+
+    def to_task(self):
+        """
+        Return the `mdq.executor.Task` to run.
+        """
+        raise NotImplemented
 
-Taskable = workqueue.Taskable
+    def update_task(self, result):
+        """
+        Update the object from the `result` of running its task.
+        """
+        raise NotImplemented
 
 class Persistable(object):
     @property
@@ -26,6 +39,32 @@ class Extendable(object):
         """
         raise NotImplemented
 
+class Adaptable(object):
+    """
+    Workers may only be available for a limited time.  The `Adaptable`
+    interface allows tasks to adjust the amount of work done by the
+    next generation to the throughput observed so far.
+    """
+
+    def adapt(self, walltime):
+        """
+        Size the next generation to run for about `walltime` seconds.
+        """
+        raise NotImplemented
+
+class Validatable(object):
+    """
+    Workers may fail in ways that still return a task.  The `Validatable`
+    interface allows tasks to check the outputs of a returned task
+    before their state is updated from it.
+    """
+
+    def validate(self, result):
+        """
+        Return what is wrong with the outputs of `result`, or None if they are valid.
+        """
+        raise NotImplemented
+
 class Preparable(object):
     """
     Different MD backends may require different steps to create a `Taskable`.
@@ -1,6 +1,8 @@
 from .  import api
+from .. import executor
+from .. import state
 from .. import stream
-from .. import workqueue as wq
+from ..digest import ALGORITHM, DigestCache, file_digest
 
 import pxul
 from pxul.logging import logger
@@ -8,9 +10,16 @@ from pxul.os import SetEnv
 
 import mdprep
 
+from contextlib import closing
+from fractions import gcd
+from multiprocessing.pool import ThreadPool
+import bz2
+import glob
+import gzip
 import hashlib
 import os
 import random
+import re
 import tempfile
 import shutil
 import textwrap
@@ -30,11 +39,37 @@ TRAJ_FILES          = dict(trr='traj.trr',
 
 SELECTIONS          = dict(positions='x', velocities='v',time='t')
 FILE_NAMES          = dict(x = 'x.gps'  , v = 'v.gps'  , t = 't.gps')
-SCRIPT_INPUT_NAMES  = dict(x = 'x_i.gps', v = 'v_i.gps', t = 't_i.gps', tpr='topol.tpr', cpus='cpus.gps')
-SCRIPT_OUTPUT_NAMES = dict(x = 'x_o.gps', v = 'v_o.gps', t = 't_o.gps')
+SCRIPT_INPUT_NAMES  = dict(x = 'x_i.gps', v = 'v_i.gps', t = 't_i.gps', tpr='topol.tpr', cpus='cpus.gps',
+                           cpt = 'state_i.cpt', nsteps = 'nsteps.gps', maxh = 'maxh.gps')
+SCRIPT_OUTPUT_NAMES = dict(x = 'x_o.gps', v = 'v_o.gps', t = 't_o.gps', cpt = 'state_o.cpt',
+                           status = 'status.gps')
+
+# How a generation continues from the previous one:
+#  guamps: positions, velocities, and time are injected into the .tpr with guamps_set
+#  checkpoint: mdrun continues from the previous checkpoint (requires mdrun -nsteps, GROMACS >= 4.6)
+CONTINUATIONS = ('guamps', 'checkpoint')
 
 SCRIPT_NAME = 'md.sh' # name of the script on the worker
+CHECKPOINT_SCRIPT_NAME = 'md_cpt.sh' # name of the script for checkpoint continuation
+CODEC_SCRIPT_NAME = 'codec.sh' # (de)compresses transferred files on the worker
+CHAIN_SCRIPT_NAME = 'chain.sh' # runs several generations in one task, see Task.chain
+CHAIN_STAGING = '.chain%d-' # prefix of the outputs of the later generations of a chain, see Task._staged
 LOGFILE = 'task.log'  # log of the task run
+TRANSFER_STATS = 'transfer.gps' # uncompressed sizes of the compressed outputs
+DONE_MARKER = 'done.gps' # written once a generation completed, holds the time it reached
+PARTIAL = 'partial' # status of a task that stopped before the end of its generation, see Task.segment
+
+# bounds on the factor by which an adapted generation length may change at once
+ADAPT_LIMITS = (0.5, 2.0)
+# weight of the latest generation in the smoothed rate used to adapt the generation length
+ADAPT_SMOOTHING = 0.5
+
+# digests of the cached inputs, see `cached_name` and `digest_cache`
+DIGESTS = None
+
+# codec name -> (program, extension, python opener)
+CODECS = dict(gzip  = ('gzip' , 'gz' , gzip.open),
+              bzip2 = ('bzip2', 'bz2', bz2.BZ2File))
 
 SCRIPT_CONTENTS = textwrap.dedent("""\
 #!/usr/bin/env bash
@@ -49,6 +84,7 @@ v_i=%(v_i)s
 t_i=%(t_i)s
 tpr=%(tpr)s
 cpus=%(cpus)s
+nsteps=%(nsteps)s
 
 # output files
 x_o=%(x_o)s
@@ -63,8 +99,16 @@ guamps_set -f $tpr -s positions  -i $x_i
 guamps_set -f $tpr -s velocities -i $v_i
 guamps_set -f $tpr -s time       -i $t_i
 
-# run with given number of processors
-mdrun -nt $(cat $cpus) -s $tpr
+# an adapted generation length overrides nsteps of the tpr (requires GROMACS >= 4.6)
+opts=
+if [ -s $nsteps ]; then
+    opts="-nsteps $(cat $nsteps)"
+fi
+
+# run with given number of processors, 'auto' uses the cores allocated by the worker
+nt=$(cat $cpus)
+if [ "$nt" = auto ]; then nt=${CORES:-0}; fi
+mdrun -nt $nt -s $tpr $opts
 
 # retrieve the positions, velocities, and time
 guamps_get -f traj.trr -s positions  -o $x_o
@@ -77,12 +121,107 @@ guamps_get -f traj.trr -s time       -o $t_o
     t_i = SCRIPT_INPUT_NAMES ['t'],
     tpr = SCRIPT_INPUT_NAMES ['tpr'],
     cpus= SCRIPT_INPUT_NAMES ['cpus'],
+    nsteps = SCRIPT_INPUT_NAMES['nsteps'],
     x_o = SCRIPT_OUTPUT_NAMES['x'],
     v_o = SCRIPT_OUTPUT_NAMES['v'],
     t_o = SCRIPT_OUTPUT_NAMES['t'],
     )
 )
 
+CHECKPOINT_SCRIPT_CONTENTS = textwrap.dedent("""\
+#!/usr/bin/env bash
+# exit if any command fails
+set -o errexit
+
+export PATH=$PWD:$PATH
+
+# input files
+cpt_i=%(cpt_i)s
+tpr=%(tpr)s
+cpus=%(cpus)s
+nsteps=%(nsteps)s
+maxh=%(maxh)s
+
+# output files
+cpt_o=%(cpt_o)s
+status=%(status)s
+
+# disable gromacs automatic backups
+export GMX_MAXBACKUP=-1
+
+# continue from the previous checkpoint, if there is one
+cpi=
+if [ -s $cpt_i ]; then
+    cpi="-cpi $cpt_i"
+fi
+
+# stop after a number of hours, leaving the rest of the generation to another task
+opts=
+if [ -s $maxh ]; then
+    opts="-maxh $(cat $maxh)"
+fi
+
+# run with given number of processors ('auto' uses the cores allocated by the worker)
+# up to the absolute step in $nsteps
+nt=$(cat $cpus)
+if [ "$nt" = auto ]; then nt=${CORES:-0}; fi
+mdrun -nt $nt -s $tpr $cpi -cpo $cpt_o -noappend -nsteps $(cat $nsteps) $opts
+
+# continuations are written as eg traj.part0002.trr: restore the usual names
+for f in *.part[0-9][0-9][0-9][0-9].*; do
+    [ -e "$f" ] || continue
+    mv "$f" "${f/.part[0-9][0-9][0-9][0-9]/}"
+done
+
+# record whether mdrun stopped at -maxh before the end of the generation
+if grep -q 'Run time exceeded' md.log; then
+    echo %(partial)s > $status
+else
+    echo > $status
+fi
+
+""" % dict(
+    cpt_i = SCRIPT_INPUT_NAMES ['cpt'],
+    tpr   = SCRIPT_INPUT_NAMES ['tpr'],
+    cpus  = SCRIPT_INPUT_NAMES ['cpus'],
+    nsteps= SCRIPT_INPUT_NAMES ['nsteps'],
+    maxh  = SCRIPT_INPUT_NAMES ['maxh'],
+    cpt_o = SCRIPT_OUTPUT_NAMES['cpt'],
+    status= SCRIPT_OUTPUT_NAMES['status'],
+    partial = PARTIAL,
+    )
+)
+
+CODEC_SCRIPT_CONTENTS = textwrap.dedent("""\
+#!/usr/bin/env bash
+# usage: %(name)s (compress|decompress) PROGRAM EXTENSION LEVEL FILES...
+# exit if any command fails
+set -o errexit
+
+mode=$1
+prog=$2
+ext=$3
+level=$4
+shift 4
+
+for f in "$@"; do
+    case $mode in
+        decompress)
+            if [ -e "$f.$ext" ]; then
+                $prog -d -f "$f.$ext"
+            fi
+            ;;
+        compress)
+            echo "$f $(wc -c < "$f")" >> %(stats)s
+            $prog -$level -f "$f"
+            ;;
+    esac
+done
+""" % dict(
+    name  = CODEC_SCRIPT_NAME,
+    stats = TRANSFER_STATS,
+    )
+)
 
 
 
@@ -97,6 +236,132 @@ guamps_get = pxul.command.OptCommand('guamps_get')
 guamps_set = pxul.command.OptCommand('guamps_set')
 
 
+def open_file(path):
+    """
+    Open a local file for reading, decompressing it if its
+    extension is that of one of the CODECS
+    """
+    for _, ext, opener in CODECS.itervalues():
+        if path.endswith('.' + ext):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+def decompress_file(path, codec):
+    """
+    Decompress `path`, which has the extension of `codec`, replacing it
+    with the decompressed file.  Returns the decompressed path.
+    """
+    _, ext, opener = CODECS[codec]
+    out = path[:-len(ext)-1]
+    with closing(opener(path, 'rb')) as src:
+        with open(out, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    os.unlink(path)
+    return out
+
+def read_mdlog(path):
+    """
+    Parse the mdrun log at `path`, returning a dict with
+      last       : (step, time) of the last energies written, or None
+      performance: dict of the columns of the 'Performance:' line, eg
+                   {'ns/day': 12.3, 'hour/ns': 1.95}, or empty
+    """
+    last, performance = None, dict()
+    with closing(open_file(path)) as fd:
+        header, previous = False, ''
+        for line in fd:
+            fields = line.split()
+            if header and len(fields) >= 2:
+                try:
+                    last = int(fields[0]), float(fields[1])
+                except ValueError:
+                    pass
+            header = fields[:2] == ['Step', 'Time']
+
+            if fields[:1] == ['Performance:']:
+                names  = re.findall(r'\(([^)]+)\)', previous)
+                values = list()
+                for value in fields[1:]:
+                    try: values.append(float(value))
+                    except ValueError: pass
+                # the columns are right-aligned with the header
+                performance = dict(zip(reversed(names), reversed(values)))
+            previous = line
+    return dict(last=last, performance=performance)
+
+def mdlog_last_step(path):
+    """
+    Return the (step, time) of the last energies written to the mdrun log at `path`,
+    or None if there are none.
+    """
+    return read_mdlog(path)['last']
+
+def read_gps_scalar(path):
+    """
+    Return the value of the GUAMPS file of a scalar at `path`, which may be compressed
+    """
+    with closing(open_file(path)) as fd:
+        return float(fd.readline())
+
+def read_done_marker(path):
+    """
+    Return the time recorded in a DONE_MARKER, or None if it is not known
+    """
+    with open(path) as fd:
+        value = fd.readline().strip()
+    return float(value) if value else None
+
+def segment_name(name, segment):
+    """
+    The name of file `name` as written by the `segment`th task of a
+    generation (see `Task.segment`): eg traj.trr, traj.seg1.trr, ...
+    """
+    if not segment: return name
+    root, ext = os.path.splitext(name)
+    return '%s.seg%d%s' % (root, segment, ext)
+
+def split_segment(path):
+    """
+    Return the (name, segment) of a file named by `segment_name`
+    """
+    match = re.match(r'^(.*)\.seg(\d+)(\.[^.]*)$', path)
+    if match is None: return path, 0
+    return match.group(1) + match.group(3), int(match.group(2))
+
+def digest_cache():
+    """
+    Return the cache of the digests of the cached inputs: within a
+    project the persistent cache of `mdq add` (see `state.DIGESTS`),
+    so that unchanged inputs are not rehashed by each `mdq run`
+    """
+    global DIGESTS
+    if DIGESTS is None:
+        DIGESTS = DigestCache(state.DIGESTS if os.path.isdir(state.DOT_DIR) else None)
+    return DIGESTS
+
+def cached_name(name, buffer=None, path=None):
+    """
+    Return the name on the worker of the cached input `name`, given
+    either by its contents `buffer` or by its local `path`, derived
+    from its contents so that workers may cache the inputs of several
+    simulations at once and never use stale copies.  The files of every
+    platform are hashed if `path` names $OS or $ARCH.
+    """
+    if buffer is not None:
+        digest = hashlib.new(ALGORITHM, buffer).hexdigest()
+    elif '$OS' in path or '$ARCH' in path:
+        paths = glob.glob(path.replace('$OS', '*').replace('$ARCH', '*'))
+        if not paths:
+            logger.warning('No files found for', path, 'caching it as', name)
+            return name
+        h = hashlib.new(ALGORITHM)
+        for digest in sorted(digest_cache().digests(paths).values()):
+            h.update(digest)
+        digest = h.hexdigest()
+    else:
+        digest = digest_cache().digest(path)
+    return '%s-%s' % (digest, name)
+
 def disable_gromacs_backups():
     """
     Intended to be used in a `with` statement:
@@ -106,28 +371,113 @@ def disable_gromacs_backups():
     """
     return SetEnv(GMX_MAXBACKUP=-1)
 
+def output_stride(*freqs):
+    """
+    The least common multiple of the output frequencies (steps) `freqs`,
+    ignoring those that are unset (0)
+    """
+    stride = 1
+    for freq in freqs:
+        if freq > 0: stride = stride * freq // gcd(stride, freq)
+    return stride
+
+def tpr_set_scalars(tpr, values):
+    """
+    Set several scalar fields of `tpr`, given as a dict or a sequence
+    of (name, value) pairs, see `tpr_set`
+    """
+    tpr_set(tpr, [], values)
+
+def tpr_set(tpr, selections, values=()):
+    """
+    Set each (selection, path) in `selections` in `tpr` from the GUAMPS
+    file `path`, and each (name, value) in the dict or sequence `values`.
+
+    `guamps_set` edits one field per call, so the edits are applied in
+    turn to a single copy of `tpr` in a local scratch directory, which
+    then replaces `tpr`: the original is copied and replaced only once
+    however many fields are changed.
+    """
+    values = values.items() if isinstance(values, dict) else list(values)
+    selections = list(selections)
+    if not selections and not values: return
+
+    scratch = tempfile.mkdtemp(prefix='mdq-tpr-')
+    try:
+        for name, value in values:
+            logger.info1('Setting', name, '=', value, 'in', tpr)
+            gps = os.path.join(scratch, name + '.gps')
+            with open(gps, 'w') as fd: fd.write('%s\n' % value)
+            selections.append((name, gps))
+
+        work = os.path.join(scratch, os.path.basename(tpr))
+        shutil.copy(tpr, work)
+        for sel, path in selections:
+            logger.debug('Setting', sel, 'from', path, 'in', tpr)
+            guamps_set(f=work, s=sel, i=path, O=True)
+        shutil.move(work, tpr)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def tpr_get_scalars(tpr, names, mktype=str, jobs=4, selections=()):
+    """
+    Get several scalar fields from `tpr`, reading up to `jobs` of them concurrently.
+    Each (selection, path) in `selections` is extracted in the same pass, see `tpr_get`.
+
+    `mktype` is either a single type or a dict of name -> type.
+    Returns a dict of name -> value.
+    """
+    scratch = tempfile.mkdtemp(prefix='mdq-tpr-')
+    try:
+        outputs = [(name, os.path.join(scratch, name + '.gps')) for name in names]
+        tpr_get(tpr, list(selections) + outputs, jobs=jobs)
+        values = dict()
+        for name, path in outputs:
+            with open(path) as fd:
+                value = fd.readline()
+            convert = mktype.get(name, str) if isinstance(mktype, dict) else mktype
+            values[name] = convert(value)
+        return values
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def tpr_get(tpr, selections, jobs=4):
+    """
+    Extract each (selection, path) in `selections` from `tpr` to the GUAMPS file `path`.
+    Up to `jobs` selections are extracted concurrently.
+    """
+    def get(item):
+        sel, path = item
+        logger.info1('Getting', sel, 'from', tpr)
+        guamps_get(f=tpr, s=sel, o=path)
+
+    selections = list(selections)
+    if jobs > 1 and len(selections) > 1:
+        pool = ThreadPool(min(jobs, len(selections)))
+        try:
+            pool.map(get, selections)
+        finally:
+            pool.close()
+    else:
+        map(get, selections)
+
 def tpr_set_scalar(tpr, name, value):
-    logger.info1('Setting', name, '=', value, 'in', tpr)
-    tmpfile = os.path.join(os.path.dirname(tpr), name +'.gps')
-    with open(tmpfile, 'w') as fd: fd.write('%s\n' % value)
-    guamps_set(f=tpr, s=name, i=tmpfile, O=True)
-    os.unlink(tmpfile)
+    tpr_set_scalars(tpr, [(name, value)])
 
 def tpr_get_scalar(tpr, name, mktype):
-    logger.info1('Getting', name, 'from', tpr)
-    tmpfile = os.path.join(os.path.dirname(tpr), name+'.gps')
-    guamps_get(f=tpr, s=name, o=tmpfile)
-    with open(tmpfile) as fd:
-        value = fd.readline()
-        value = mktype(value)
-    os.unlink(tmpfile)
-    return value
+    return tpr_get_scalars(tpr, [name], mktype=mktype)[name]
 
 class Prepare(api.Preparable):
     def __init__(self,
                  picoseconds=None, outputfreq=None,
                  cpus=0, mdrun=None, guamps_get=None, guamps_set=None,
-                 keep_trajfiles=True):
+                 keep_trajfiles=True, continuation='guamps',
+                 compression=None, compression_level=6,
+                 memory=None, disk=None):
+        if continuation not in CONTINUATIONS:
+            raise ValueError, 'Unknown continuation %s, expected one of %s' % (continuation, ', '.join(CONTINUATIONS))
+        if continuation == 'checkpoint' and not picoseconds:
+            raise ValueError, 'Checkpoint continuation requires the picoseconds per generation'
         self._picoseconds = picoseconds
         self._outputfreq = outputfreq
         self._cpus = cpus
@@ -135,6 +485,11 @@ class Prepare(api.Preparable):
         self._guamps_get = guamps_get
         self._guamps_set = guamps_set
         self._keep_trajfiles = keep_trajfiles
+        self._continuation = continuation
+        self._compression = compression
+        self._compression_level = compression_level
+        self._memory = memory
+        self._disk = disk
 
     def task(self, tpr, x=None, v=None, t=None, outputdir=None, seed=None, digest=None):
         outdir = outputdir or tpr + '.mdq'
@@ -168,41 +523,59 @@ class Prepare(api.Preparable):
                 logger.debug(t, '->', gps['t'])
             else: raise ValueError, 'Illegal state: invalid time spec %s' % t
 
-
-        for sel, key in SELECTIONS.iteritems():
-            logger.info1('Getting', sel, 'from', tpr2)
-            guamps_get(f=tpr2, s=sel, o=gps[key])
-
+        initial = list()
+        if self._continuation == 'checkpoint':
+            # the initial state is only injected once, the checkpoints carry it afterwards
+            initial = [(sel, gps[key]) for sel, key, given in
+                       [('positions', 'x', x), ('velocities', 'v', v), ('time', 't', t)]
+                       if given is not None]
+
+        # the state not injected is read along with the fields the edits depend on,
+        # and the output frequencies of the state if they are not set here
+        injected = set(sel for sel, _ in initial)
+        extract = [(sel, gps[key]) for sel, key in SELECTIONS.iteritems() if sel not in injected]
+        names = ['deltat'] if self._outputfreq else ['deltat', 'nstxout', 'nstvout']
+        scalars = tpr_get_scalars(tpr2, names, mktype=dict(deltat=float, nstxout=int, nstvout=int),
+                                  selections=extract)
+        dt = scalars['deltat']
+
+        edits = list()
         if seed:
             logger.info1('Setting seed', seed)
-            tpr_set_scalar(tpr2, 'ld_seed', seed)
+            edits.append(('ld_seed', seed))
 
-        dt = tpr_get_scalar(tpr2, 'deltat', float)
+        nsteps = None
         if self._picoseconds:
             nsteps = int(self._picoseconds / dt)
             logger.info1('Running for', self._picoseconds, 'ps as', nsteps, 'nsteps')
-            tpr_set_scalar(tpr2, 'nsteps', nsteps)
+            edits.append(('nsteps', nsteps))
 
+        # generations end on a step where the positions and velocities are written,
+        # so that the next one continues from the end of the trajectory
+        freq = output_stride(scalars.get('nstxout', 0), scalars.get('nstvout', 0))
         if self._outputfreq:
             freq = int(self._outputfreq / dt)
             # FIXME nstenergy, see badi/guamps#27
             for attr in 'nstxout nstxtcout nstfout nstvout nstlog'.split():
                 logger.info1('Setting output frequency', self._outputfreq,
                              'for', attr, 'as', freq, 'steps', 'in', tpr2)
-                tpr_set_scalar(tpr2, attr, freq)
+                edits.append((attr, freq))
+
+        tpr_set(tpr2, initial, edits)
 
         if not digest:
             logger.info1('Computing digest for', tpr2)
-            sha256 = hashlib.sha256()
-            sha256.update(open(tpr2, 'rb').read())
-            digest = sha256.hexdigest()
+            digest = file_digest(tpr2)
 
         task = Task(x=gps['x'], v=gps['v'], t=gps['t'], tpr=tpr2,
-                    outputdir=outdir, cpus=self._cpus, digest=digest)
+                    outputdir=outdir, cpus=self._cpus, memory=self._memory, disk=self._disk, digest=digest,
+                    continuation=self._continuation, nsteps=nsteps, dt=dt, stride=freq,
+                    compression=self._compression, compression_level=self._compression_level)
 
         task.add_binary(self._mdrun)
-        task.add_binary(self._guamps_get)
-        task.add_binary(self._guamps_set)
+        if self._continuation != 'checkpoint':
+            task.add_binary(self._guamps_get)
+            task.add_binary(self._guamps_set)
 
         if self._keep_trajfiles:
             task.keep_trajfiles()
@@ -212,7 +585,7 @@ class Prepare(api.Preparable):
             logger.info(10*' ', k.lstrip('_'), '=', getattr(self, k))
         return task
 
-class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
+class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable, api.Adaptable, api.Validatable):
     """
     This represents everything needed to run a simulation.
 
@@ -238,11 +611,62 @@ class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
     ...   assert task.result == 0
     ...   sim.extend()
 
+    With `continuation='checkpoint'` each generation continues from the
+    checkpoint written by the previous one, and runs until `nsteps`
+    more steps have been done.
+
+    With a `compression` codec (see CODECS) the worker compresses the
+    state and trajectory files before they are transferred back, and
+    decompresses the state files it receives.  The state files are kept
+    compressed locally, the trajectory files are decompressed on receipt.
+
+    The timing of each completed generation, as reported by Work Queue
+    and by mdrun, is recorded in `history`.  `adapt` uses the observed
+    rate to size the next generation for a target walltime, overriding
+    `nsteps` in multiples of `stride` steps.
+
+    Each task declares `cpus` cores, and `memory` and `disk` (MB) if
+    given, so that workers may run several simulations at once.  With
+    `cpus='auto'` no cores are declared, so a task gets a whole worker,
+    and mdrun uses the cores allocated to it.
+
+    With a `chain` of K generations each task runs K generations back
+    to back on the worker, and returns the outputs of each one to its
+    own `outputdir`, as if they had run as separate tasks.
+
+    With checkpoint continuation and a `segment` of H hours, mdrun stops
+    after about H hours and returns its checkpoint, and the generation is
+    continued from there by the next task (see `partial`), so a worker
+    evicted during a long generation loses at most one segment.  The
+    trajectory files of the later segments of a generation are named by
+    `segment_name`.
     """
 
+    # defaults for attributes added after tasks may have been persisted
+    _continuation = 'guamps'
+    _nsteps       = None
+    _step         = 0
+    _cpt          = None
+    _compression  = None
+    _compression_level = 6
+    _transfer     = (0, 0)
+    _history      = ()
+    _dt           = None
+    _stride       = 1
+    _adapted      = None
+    _rate         = None
+    _chain        = 1
+    _memory       = None
+    _disk         = None
+    _segment      = None
+    _segments     = 0
+    _partial      = False
+
     def __init__(self,
                  x='x.gps', v='v.gps', t='t.gps', tpr='topol.tpr',
-                 outputdir=None, cpus=0, digest=None
+                 outputdir=None, cpus=0, memory=None, disk=None, digest=None,
+                 continuation='guamps', nsteps=None, dt=None, stride=1,
+                 compression=None, compression_level=6
                  ):
 
         super(Task, self).__init__()
@@ -252,9 +676,36 @@ class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
         self._t         = t # start time
         self._tpr       = tpr
         self._outputdir = outputdir if outputdir is not None else os.path.splitext(tpr)[0] + '.mdq'
-        self._cpus      = cpus
+        self._cpus      = cpus # or 'auto'
+        self._memory    = memory
+        self._disk      = disk
         self._digest    = digest
 
+        if continuation not in CONTINUATIONS:
+            raise ValueError, 'Unknown continuation %s, expected one of %s' % (continuation, ', '.join(CONTINUATIONS))
+        if continuation == 'checkpoint' and nsteps is None:
+            raise ValueError, 'Checkpoint continuation requires nsteps'
+        self._continuation = continuation
+        self._nsteps       = nsteps  # steps per generation
+        self._step         = 0       # step at the start of the generation
+        self._cpt          = None    # checkpoint to continue from
+        self._dt           = dt      # picoseconds per step
+        self._stride       = stride  # adapted generation lengths are multiples of this
+        self._adapted      = None    # steps of the current generation, if adapted
+        self._rate         = None    # smoothed steps per second of walltime
+        self._chain        = 1       # generations run by each task
+        self._segment      = None    # hours after which mdrun stops, see `segment`
+        self._segments     = 0       # tasks of the current generation that stopped early
+        self._partial      = False   # the last task stopped before the end of the generation
+
+        if compression is not None and compression not in CODECS:
+            raise ValueError, 'Unknown compression %s, expected one of %s' % (compression, ', '.join(CODECS))
+        self._compression       = compression
+        self._compression_level = compression_level
+        self._transfer          = (0, 0) # total bytes before and after compression
+
+        self._history = list() # one dict per completed generation, see `_record`
+
         self._generation = 0
         self._binaries   = list()
         self._trajfiles  = list()
@@ -290,41 +741,106 @@ class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
         logger.debug('Adding binary', path)
         self._binaries.append(path)
 
+    @property
+    def executables(self):
+        """The executables needed on the worker"""
+        if self._continuation == 'checkpoint':
+            return ['mdrun']
+        return EXECUTABLES
+
     def check_binaries(self):
         """Checks that the required executables (EXECUTABLES) have been added"""
         logger.debug('Checking that all executables were added')
-        found    = 0
-        notfound = list()
-        for path in self._binaries:
-            base = os.path.basename(path)
-            for name in EXECUTABLES:
-                if name == base:
-                    logger.debug('Found', name, 'as', path)
-                    found += 1
-                    continue
-                notfound.append(name)
-        if not found == len(EXECUTABLES):
+        names    = set(os.path.basename(path) for path in self._binaries)
+        notfound = [name for name in self.executables if name not in names]
+        if notfound:
             raise ValueError, 'Binaries for %s were not added' % ', '.join(notfound)
 
+    @property
+    def continuation(self):
+        """How each generation continues from the previous one (see CONTINUATIONS)"""
+        return self._continuation
+
+    @property
+    def nsteps(self):
+        """The number of steps of the current generation, if known"""
+        return self._adapted if self._adapted is not None else self._nsteps
+
+    @property
+    def chain(self):
+        """The number of generations run back to back by each task"""
+        return self._chain
+
+    @chain.setter
+    def chain(self, generations):
+        self._chain = max(1, int(generations))
+
+    @property
+    def segment(self):
+        """Hours after which a task stops, leaving the rest of the generation to the next task"""
+        return self._segment
+
+    @segment.setter
+    def segment(self, hours):
+        if hours and self._continuation != 'checkpoint':
+            raise ValueError, 'Segments require checkpoint continuation, not %s' % self._continuation
+        self._segment = hours or None
+
+    @property
+    def segments(self):
+        """The number of tasks of the current generation that stopped early"""
+        return self._segments
+
+    @property
+    def partial(self):
+        """Did the last task stop before the end of its generation?"""
+        return self._partial
+
+    @property
+    def state_keys(self):
+        """Keys of the files carrying the simulation state between generations"""
+        return ['cpt'] if self._continuation == 'checkpoint' else ['x', 'v', 't']
+
+    @property
+    def transfer(self):
+        """Total bytes of compressed outputs (before, after) compression"""
+        return self._transfer
+
+    def _compressed(self, name):
+        """The name of file `name` once compressed, if compression is enabled"""
+        if self._compression is None: return name
+        return '%s.%s' % (name, CODECS[self._compression][1])
+
     @property
     def input_files(self):
         """Input files for the simulation script"""
-        return dict(x=self._x, v=self._v, t=self._t, tpr=self._tpr)
+        files = dict((key, getattr(self, '_' + key)) for key in self.state_keys)
+        files['tpr'] = self._tpr
+        return files
 
     @property
     def output_files(self):
         """Files needed to start the next generation"""
-        return dict(x = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['x']),
-                    v = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['v']),
-                    t = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['t']),
-                    log=os.path.join(self.outputdir, LOGFILE),
-                    )
+        files = dict((key, os.path.join(self.outputdir, self._compressed(SCRIPT_OUTPUT_NAMES[key])))
+                     for key in self.state_keys)
+        files['log'] = os.path.join(self.outputdir, LOGFILE)
+        return files
 
     @property
     def generation(self):
         """The current generation"""
         return self._generation
 
+    @property
+    def history(self):
+        """The records of the completed generations, see `_record`"""
+        return list(self._history)
+
+    @property
+    def ns_per_day(self):
+        """The performance reported by mdrun for the last completed generation, if known"""
+        return self._history[-1]['ns_per_day'] if self._history else None
+
     @property
     def outputdir(self):
         """The output directory for the current generation"""
@@ -343,10 +859,77 @@ class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
     def extend(self):
         """Set the file names to run the next generation"""
         logger.debug('Extending generation:', self._generation, '->', self._generation + 1)
-        self._x = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['x'])
-        self._v = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['v'])
-        self._t = os.path.join(self.outputdir, SCRIPT_OUTPUT_NAMES['t'])
+        outputs = self.output_files
+        for key in self.state_keys:
+            setattr(self, '_' + key, outputs[key])
+        if self._continuation == 'checkpoint':
+            self._step += self.nsteps
         self._generation += 1
+        self._segments   = 0
+        self._partial    = False
+
+    ###################################################################### Implement the Adaptable interface
+    def adapt(self, walltime):
+        """
+        Set the steps of the current generation so that it runs for
+        about `walltime` seconds at the rate observed so far.  The
+        length changes at most by the factors in ADAPT_LIMITS at once.
+        """
+        if not self._rate:
+            logger.debug('No rate observed yet for', self.digest, 'keeping', self.nsteps, 'steps')
+            return
+        nsteps = self._rate * walltime
+        if self.nsteps:
+            low, high = ADAPT_LIMITS
+            nsteps = min(max(nsteps, low * self.nsteps), high * self.nsteps)
+        nsteps = max(self._stride, int(nsteps) // self._stride * self._stride)
+        if nsteps != self.nsteps:
+            logger.info1('Adapting generation', self._generation, 'of', self.digest,
+                         'from', self.nsteps, 'to', nsteps, 'steps',
+                         'for a walltime of', walltime, 's')
+        self._adapted = nsteps
+
+    def _observe(self, record):
+        """
+        Update the smoothed rate (steps per second) from the record of a completed generation
+        """
+        if record['nsteps'] and record['execution']:
+            rate = record['nsteps'] / record['execution']
+        elif record['ns_per_day'] and self._dt:
+            rate = record['ns_per_day'] * 1000 / (24 * 60 * 60 * self._dt)
+        else:
+            return
+        self._rate = rate if self._rate is None \
+                     else ADAPT_SMOOTHING * rate + (1 - ADAPT_SMOOTHING) * self._rate
+
+    ###################################################################### Implement the Validatable interface
+    def validate(self, result):
+        """
+        Check that the task returned the state of each generation it ran,
+        and that the simulation advanced past the start of the generation
+        """
+        def received(name, i): return self._staged(self.output_path(name), i)
+        for i in xrange(self._chain):
+            for key in self.state_keys:
+                path = received(self._compressed(SCRIPT_OUTPUT_NAMES[key]), i)
+                if not os.path.exists(path) or os.path.getsize(path) == 0:
+                    return 'missing output %s' % path
+        last = self._chain - 1
+        try:
+            if self._continuation == 'checkpoint':
+                # the steps are only known if the log is kept
+                segment = self._segments if self._chain == 1 else 0
+                log = received(self._compressed(segment_name(TRAJ_FILES['log'], segment)), last)
+                last = read_mdlog(log)['last'] if os.path.exists(log) else None
+                if last is not None and last[0] <= self._step:
+                    return 'step %d did not advance past %d' % (last[0], self._step)
+            else:
+                before = read_gps_scalar(self._t)
+                after  = read_gps_scalar(received(self._compressed(SCRIPT_OUTPUT_NAMES['t']), last))
+                if after <= before:
+                    return 'time %s did not advance past %s' % (after, before)
+        except (IOError, ValueError), e:
+            return 'unreadable output: %s' % e
 
     ###################################################################### Implement Taskable interface
     def to_task(self):
@@ -355,32 +938,266 @@ class Task(stream.Unique, api.Taskable, api.Persistable, api.Extendable):
         pxul.os.ensure_dir(self.outputdir)
         logger.debug('Ensured', self.outputdir, 'exists')
 
-        cmd = 'bash %(script)s > %(log)s' % dict(script = SCRIPT_NAME, log = LOGFILE)
-        task = wq.Task(cmd)
+        checkpoint = self._continuation == 'checkpoint'
+        script, contents = (CHECKPOINT_SCRIPT_NAME, CHECKPOINT_SCRIPT_CONTENTS) if checkpoint \
+                           else (SCRIPT_NAME, SCRIPT_CONTENTS)
+
+        codec = None
+        if self._compression is not None:
+            codec = 'bash %s %%s %s %s %d' % ((CODEC_SCRIPT_NAME,) + CODECS[self._compression][:2] + (self._compression_level,))
+        inputs  = [SCRIPT_INPUT_NAMES[key] for key in self.state_keys]
+        outputs = [SCRIPT_OUTPUT_NAMES[key] for key in self.state_keys] + self._trajfiles
+
+        if self._chain > 1:
+            cmd = 'bash %s' % CHAIN_SCRIPT_NAME
+        else:
+            cmd = 'bash %(script)s > %(log)s' % dict(script = script, log = LOGFILE)
+            if codec is not None:
+                cmd = ' && '.join([cmd, codec % 'compress' + ' ' + ' '.join(outputs)])
+        if codec is not None:
+            cmd = ' && '.join([codec % 'decompress' + ' ' + ' '.join(inputs), cmd])
+
+        # cached inputs are named by their contents on the worker and
+        # linked into the sandbox, guamps_set modifies the tpr so copy it
+        cached = [(contents, script, None),
+                  (str(self._cpus), SCRIPT_INPUT_NAMES['cpus'], None),
+                  (None, SCRIPT_INPUT_NAMES['tpr'], self._tpr)]
+        if self._compression is not None:
+            cached.append((CODEC_SCRIPT_CONTENTS, CODEC_SCRIPT_NAME, None))
+        self.check_binaries()
+        cached.extend((None, os.path.basename(path), path) for path in self._binaries)
 
-        # input files
-        task.specify_buffer(SCRIPT_CONTENTS, SCRIPT_NAME              , cache=True)
-        task.specify_buffer(str(self._cpus), SCRIPT_INPUT_NAMES['cpus'],cache=True)
-        task.specify_input_file(self._x    , SCRIPT_INPUT_NAMES['x']  , cache=False, name='x_i')
-        task.specify_input_file(self._v    , SCRIPT_INPUT_NAMES['v']  , cache=False, name='v_i')
-        task.specify_input_file(self._t    , SCRIPT_INPUT_NAMES['t']  , cache=False, name='t_i')
-        task.specify_input_file(self._tpr  , SCRIPT_INPUT_NAMES['tpr'], cache=True , name='tpr')
+        remotes, setup = list(), list()
+        for buffer, name, path in cached:
+            remote = cached_name(name, buffer=buffer, path=path)
+            remotes.append(remote)
+            if remote == name: continue
+            link = 'cp' if name == SCRIPT_INPUT_NAMES['tpr'] and not checkpoint else 'ln -sf'
+            setup.append('%s %s %s' % (link, remote, name))
 
-        # output files
-        task.specify_output_file(self.output_files['log'], LOGFILE                 , cache=False, name='log')
-        task.specify_output_file(self.output_files['x'], SCRIPT_OUTPUT_NAMES['x']  , cache=False, name='x_o')
-        task.specify_output_file(self.output_files['v'], SCRIPT_OUTPUT_NAMES['v']  , cache=False, name='v_o')
-        task.specify_output_file(self.output_files['t'], SCRIPT_OUTPUT_NAMES['t']  , cache=False, name='t_o')
+        task = executor.Task(' && '.join(setup + [cmd]))
+        self._specify_resources(task)
 
-        self.check_binaries()
-        for path in self._binaries:
-            task.specify_input_file(path, cache=True)
+        # input files
+        for (buffer, name, path), remote in zip(cached, remotes):
+            if buffer is not None:
+                task.specify_buffer(buffer, remote, cache=True)
+            elif name == SCRIPT_INPUT_NAMES['tpr']:
+                task.specify_input_file(path, remote, cache=True, name='tpr')
+            else:
+                task.specify_input_file(path, remote, cache=True)
+        if self._chain > 1:
+            task.specify_buffer(self._chain_script(script, codec, outputs), CHAIN_SCRIPT_NAME, cache=False)
+        elif checkpoint:
+            task.specify_buffer(str(self._step + self.nsteps), SCRIPT_INPUT_NAMES['nsteps'], cache=False)
+            if self._segment:
+                task.specify_buffer(str(self._segment), SCRIPT_INPUT_NAMES['maxh'], cache=False)
+        elif self._adapted is not None:
+            task.specify_buffer(str(self._adapted), SCRIPT_INPUT_NAMES['nsteps'], cache=False)
+        for key, path in self.input_files.iteritems():
+            if key == 'tpr' or path is None: continue # the first checkpoint generation has no checkpoint
+            remote = SCRIPT_INPUT_NAMES[key]
+            if self._compression is not None and path.endswith(self._compressed('')):
+                remote = self._compressed(remote)
+            task.specify_input_file(path, remote, cache=False, name=key + '_i')
 
-        for name in self._trajfiles:
-            task.specify_output_file(self.output_path(name), name, cache=False)
+        # output files
+        if self._chain > 1:
+            # the directories of the later generations are only created
+            # once they have run, see `_unstage`
+            for i in xrange(self._chain):
+                self._specify_outputs(task, self.outputdir, prefix='%d/' % i, suffix='_%d' % i,
+                                      segment=self._segments if i == 0 else 0, staging=i)
+        else:
+            self._specify_outputs(task, self.outputdir, segment=self._segments)
 
         logger.debug('Created task:\n', str(task))
 
         return task
 
-    def update_task(self, task): pass
+    def _specify_resources(self, task):
+        """
+        Declare the cores, memory, and disk needed by the task
+        """
+        if self._cpus != 'auto' and self._cpus > 0:
+            task.specify_cores(self._cpus)
+        if self._memory:
+            task.specify_memory(self._memory)
+        if self._disk:
+            task.specify_disk(self._disk)
+
+    def _specify_outputs(self, task, outdir, prefix='', suffix='', segment=0, staging=0):
+        """
+        Specify the outputs of a generation, found under `prefix` on the
+        worker, to be put in `outdir`.  The named files get `suffix`, the
+        trajectory files are named for the `segment` of the generation.
+        The outputs of the `staging`th generation of a chain are received
+        under the names given by `_staged`.
+        """
+        def local(name): return self._staged(os.path.join(outdir, name), staging)
+        task.specify_output_file(local(LOGFILE), prefix + LOGFILE, cache=False, name='log' + suffix)
+        for key in self.state_keys:
+            name = self._compressed(SCRIPT_OUTPUT_NAMES[key])
+            task.specify_output_file(local(name), prefix + name, cache=False, name=key + '_o' + suffix)
+        if self._continuation == 'checkpoint':
+            name = SCRIPT_OUTPUT_NAMES['status']
+            task.specify_output_file(local(name), prefix + name, cache=False)
+        if self._compression is not None:
+            task.specify_output_file(local(TRANSFER_STATS), prefix + TRANSFER_STATS, cache=False)
+        for name in self._trajfiles:
+            task.specify_output_file(local(self._compressed(segment_name(name, segment))),
+                                     prefix + self._compressed(name), cache=False)
+
+    def _chain_script(self, script, codec, outputs):
+        """
+        Return the script running `self.chain` generations, each in its own directory (0, 1, ...)
+        and continuing from the state written by the previous one
+        """
+        checkpoint = self._continuation == 'checkpoint'
+        if codec is not None:
+            # compress from within the generation directory
+            codec = (codec % 'compress').replace(CODEC_SCRIPT_NAME, '../' + CODEC_SCRIPT_NAME, 1)
+        lines = ['#!/usr/bin/env bash', 'set -o errexit', '', 'export PATH=$PWD:$PATH', '']
+        for i in xrange(self._chain):
+            lines.append('# generation %d' % (self._generation + i))
+            lines.append('mkdir -p %d' % i)
+            lines.append('cp %s %s %d/' % (SCRIPT_INPUT_NAMES['tpr'], SCRIPT_INPUT_NAMES['cpus'], i))
+            for key in self.state_keys:
+                if i == 0: # the first checkpoint generation has no checkpoint
+                    src = SCRIPT_INPUT_NAMES[key]
+                    lines.append('if [ -e %s ]; then cp %s %d/%s; fi' % (src, src, i, SCRIPT_INPUT_NAMES[key]))
+                else:
+                    src = '%d/%s' % (i - 1, SCRIPT_OUTPUT_NAMES[key])
+                    lines.append('cp %s %d/%s' % (src, i, SCRIPT_INPUT_NAMES[key]))
+            if checkpoint:
+                lines.append('echo %d > %d/%s' % (self._step + (i + 1) * self.nsteps, i, SCRIPT_INPUT_NAMES['nsteps']))
+            elif self._adapted is not None:
+                lines.append('echo %d > %d/%s' % (self._adapted, i, SCRIPT_INPUT_NAMES['nsteps']))
+            if i > 0 and codec is not None:
+                lines.append('(cd %d && %s %s)' % (i - 1, codec, ' '.join(outputs)))
+            lines.append('(cd %d && bash ../%s > %s)' % (i, script, LOGFILE))
+            lines.append('')
+        if codec is not None:
+            lines.append('(cd %d && %s %s)' % (self._chain - 1, codec, ' '.join(outputs)))
+        return '\n'.join(lines) + '\n'
+
+    def _staged(self, path, i):
+        """
+        The local `path` under which the output of the `i`th generation of
+        a chain is received: files of the later generations are received
+        in the directory of the first one, and moved to their own once it ran
+        """
+        if i == 0: return path
+        return os.path.join(os.path.dirname(path), CHAIN_STAGING % i + os.path.basename(path))
+
+    def _unstage(self, first, i):
+        """
+        Move the outputs of the `i`th generation of a chain from the
+        directory `first` of the first one to the current generation
+        """
+        pxul.os.ensure_dir(self.outputdir)
+        prefix = CHAIN_STAGING % i
+        for name in os.listdir(first):
+            if name.startswith(prefix):
+                shutil.move(os.path.join(first, name), self.output_path(name[len(prefix):]))
+
+    def update_task(self, task):
+        # a chained task leaves the simulation at the last generation it ran
+        first = self.outputdir
+        for i in xrange(self._chain):
+            if i > 0:
+                self.extend()
+                self._unstage(first, i)
+            if self._compression is not None:
+                self._update_transfer()
+            log = self.output_path(segment_name(TRAJ_FILES['log'], self._segments))
+            mdlog = read_mdlog(log) if os.path.exists(log) else dict(last=None, performance=dict())
+            self._partial = self._stopped_early()
+            self._record(task, mdlog['performance'], share=self._chain)
+            if self._partial:
+                self._continue_segment()
+            else:
+                self._mark_done(mdlog['last'])
+
+    def _stopped_early(self):
+        """
+        Did mdrun stop before the end of the generation (see `segment`)?
+        """
+        path = self.output_path(SCRIPT_OUTPUT_NAMES['status'])
+        if not os.path.exists(path): return False
+        with open(path) as fd:
+            return fd.read().strip() == PARTIAL
+
+    def _continue_segment(self):
+        """
+        Continue the current generation from the checkpoint returned by the task that stopped early
+        """
+        self._cpt = self.output_files['cpt']
+        self._segments += 1
+        logger.info1('Generation', self._generation, 'of', self.digest, 'stopped early,',
+                     'continuing from its checkpoint as segment', self._segments)
+
+    def _mark_done(self, last):
+        """
+        Record that the generation completed, along with the simulation time it reached
+        """
+        with open(self.output_path(DONE_MARKER), 'w') as fd:
+            fd.write('%s\n' % ('' if last is None else last[1]))
+
+    def _record(self, task, performance, share=1):
+        """
+        Append the record of the completed generation to the history:
+          generation, host, submitted, finished (seconds since the epoch),
+          execution, transfer (seconds), bytes: as reported by Work Queue,
+            split evenly between the `share` generations run by the task
+          nsteps: the steps run, if known (not for the segments of a generation)
+          segment, partial: the segment of the generation, and whether it stopped early
+          ns_per_day, hours_per_ns: as reported by mdrun, if its log was kept
+        """
+        def seconds(name, share=1):
+            usec = stream.result_attr(task, name)
+            return usec / 1e6 / share if usec is not None else None
+
+        transferred = stream.result_attr(task, 'total_bytes_transferred')
+
+        record = dict(
+            generation   = self._generation,
+            host         = stream.result_attr(task, 'hostname'),
+            submitted    = seconds('submit_time'),
+            finished     = seconds('finish_time'),
+            execution    = seconds('cmd_execution_time', share),
+            transfer     = seconds('total_transfer_time', share),
+            bytes        = transferred / share if transferred is not None else None,
+            nsteps       = None if self._partial or self._segments else self.nsteps,
+            segment      = self._segments,
+            partial      = self._partial,
+            ns_per_day   = performance.get('ns/day'),
+            hours_per_ns = performance.get('hour/ns'),
+            )
+        self._history = list(self._history) + [record]
+        self._observe(record)
+        logger.info1('Generation', self._generation, 'of', self.digest, 'ran on', record['host'],
+                     'in', record['execution'], 's at', record['ns_per_day'], 'ns/day')
+
+    def _update_transfer(self):
+        """
+        Account for the bytes saved by compression and decompress the trajectory files
+        """
+        before = 0
+        with open(self.output_path(TRANSFER_STATS)) as fd:
+            for line in fd:
+                name, size = line.split()
+                before += int(size)
+
+        trajfiles  = [segment_name(name, self._segments) for name in self._trajfiles]
+        compressed = [self.output_files[key] for key in self.state_keys] \
+                   + [self._compressed(self.output_path(name)) for name in trajfiles]
+        after = sum(os.path.getsize(path) for path in compressed)
+
+        for name in trajfiles:
+            decompress_file(self._compressed(self.output_path(name)), self._compression)
+
+        self._transfer = (self._transfer[0] + before, self._transfer[1] + after)
+        logger.info1('Compressed', before, 'to', after, 'bytes',
+                     '(%.1f%% saved)' % (100. * (before - after) / max(before, 1)),
+                     'for', self.digest, 'generation', self.generation)
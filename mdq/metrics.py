@@ -0,0 +1,216 @@
+"""
+Instrumentation of the master.
+
+Counters, gauges, and histograms are created through a `Registry`
+(the module-level `registry` by default) and can be exported
+periodically to a file as JSON, or served as JSON over HTTP.
+"""
+
+from pxul.logging import logger
+
+import BaseHTTPServer
+import bisect
+import json
+import os
+import threading
+import time
+
+
+class Counter(object):
+    """A monotonically increasing value"""
+
+    def __init__(self, name, help=''):
+        self.name  = name
+        self.help  = help
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock: self._value += amount
+
+    @property
+    def value(self): return self._value
+
+    def snapshot(self):
+        return dict(type='counter', help=self.help, value=self._value)
+
+
+class Gauge(object):
+    """A value that may go up and down"""
+
+    def __init__(self, name, help=''):
+        self.name  = name
+        self.help  = help
+        self._value = None
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self): return self._value
+
+    def snapshot(self):
+        return dict(type='gauge', help=self.help, value=self._value)
+
+
+class Histogram(object):
+    """
+    The distribution of observed values, bucketed by `bounds`
+    (by default powers of two from 1ms to about 12 days)
+    """
+
+    BOUNDS = [0.001 * 2**k for k in xrange(31)]
+
+    def __init__(self, name, help='', bounds=None):
+        self.name    = name
+        self.help    = help
+        self._bounds = sorted(bounds or self.BOUNDS)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._count  = 0
+        self._sum    = 0.0
+        self._min    = None
+        self._max    = None
+        self._lock   = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self._bounds, value)] += 1
+            self._count += 1
+            self._sum   += value
+            self._min    = value if self._min is None else min(self._min, value)
+            self._max    = value if self._max is None else max(self._max, value)
+
+    @property
+    def count(self): return self._count
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count else None
+
+    def quantile(self, q):
+        """
+        Estimate the `q` quantile as the upper bound of the bucket containing it
+        """
+        if not self._count: return None
+        rank = q * self._count
+        seen = 0
+        for bound, count in zip(self._bounds + [self._max], self._counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self._max)
+        return self._max
+
+    def snapshot(self):
+        with self._lock:
+            return dict(type='histogram', help=self.help,
+                        count=self._count, sum=self._sum, min=self._min, max=self._max,
+                        mean=self.mean,
+                        p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+class Registry(object):
+    """
+    A named collection of metrics.
+    Asking for a metric that already exists returns it.
+    """
+
+    def __init__(self):
+        self._metrics = dict()
+        self._lock    = threading.Lock()
+        self._start   = time.time()
+
+    def _get(self, cls, name, **kws):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, **kws)
+            return self._metrics[name]
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help=help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help=help)
+
+    def histogram(self, name, help='', bounds=None):
+        return self._get(Histogram, name, help=help, bounds=bounds)
+
+    def snapshot(self):
+        """
+        Return a JSON-serializable dict of the current values
+        """
+        with self._lock:
+            metrics = dict(self._metrics)
+        now = time.time()
+        return dict(time=now, uptime=now - self._start,
+                    metrics=dict((name, m.snapshot()) for name, m in metrics.iteritems()))
+
+registry = Registry()
+
+
+class FileExporter(object):
+    """
+    Periodically write the snapshot of a registry to `path` as JSON
+    """
+
+    def __init__(self, path, interval=10, registry=registry):
+        self._path     = path
+        self._interval = interval
+        self._registry = registry
+        self._stop     = threading.Event()
+        self._thread   = threading.Thread(target=self._run, name='mdq-metrics-file')
+        self._thread.daemon = True
+
+    def write(self):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self._registry.snapshot(), fd, indent=2)
+        os.rename(tmp, self._path)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.write()
+
+    def start(self):
+        logger.info('Writing metrics to', self._path, 'every', self._interval, 'seconds')
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+class HTTPExporter(object):
+    """
+    Serve the snapshot of a registry as JSON on http://`host`:`port`/
+    """
+
+    def __init__(self, port, host='localhost', registry=registry):
+        reg = registry
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(reg.snapshot(), indent=2)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mdq-metrics-http')
+        self._thread.daemon = True
+
+    def start(self):
+        host, port = self._server.server_address
+        logger.info('Serving metrics on http://%s:%d/' % (host, port))
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
@@ -1,5 +1,8 @@
-import pickle
+import cPickle as pickle
 import shelve
+import sqlite3
+import threading
+import time
 
 class Persistent(object):
     def __init__(self, name, flag='c', protocol=0, writeback=False):
@@ -37,3 +40,193 @@ class Persistent(object):
 
     def __str__(self):
         return str(self._shelf)
+
+
+class Store(object):
+    """
+    Transactional key-value store backed by SQLite.
+
+    Provides the same mapping interface as `Persistent`, but values
+    are pickled using the binary protocol and the database runs in
+    write-ahead-log mode, so that a crash loses at most the
+    uncommitted writes and never corrupts the store.
+
+    Writes are grouped into transactions: a commit happens every
+    `batch` writes, or when `sync` is called.
+
+    The connection is shared by the threads using the store, so every
+    statement is run under a lock.
+    """
+
+    SCHEMA = 'CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB NOT NULL)'
+
+    def __init__(self, name, flag='c', protocol=pickle.HIGHEST_PROTOCOL, batch=1):
+        self._name     = name
+        self._protocol = protocol
+        self._batch    = max(1, batch)
+        self._pending  = 0
+        self._lock     = threading.RLock()
+        self._db       = sqlite3.connect(name, isolation_level=None, check_same_thread=False)
+        self._db.text_factory = str
+        if flag == 'r':
+            self._db.execute('PRAGMA query_only = ON')
+        else:
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.execute('PRAGMA synchronous = FULL')
+            self._db.execute(self.SCHEMA)
+
+    @property
+    def name(self): return self._name
+
+    def _write(self, sql, *args):
+        with self._lock:
+            if self._pending == 0:
+                self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute(sql, args)
+            self._pending += 1
+            if self._pending >= self._batch:
+                self.sync()
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def __contains__(self, key):
+        return bool(self._query('SELECT 1 FROM store WHERE key = ?', key))
+
+    def __del__(self):
+        self.close()
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self: raise KeyError(key)
+            self._write('DELETE FROM store WHERE key = ?', key)
+
+    def __getitem__(self, key):
+        rows = self._query('SELECT value FROM store WHERE key = ?', key)
+        if not rows: raise KeyError(key)
+        return pickle.loads(str(rows[0][0]))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM store')[0][0]
+
+    def __setitem__(self, key, value):
+        data = pickle.dumps(value, self._protocol)
+        self._write('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)',
+                    key, sqlite3.Binary(data))
+
+    def __str__(self):
+        return str(dict(self.items()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [row[0] for row in self._query('SELECT key FROM store')]
+
+    def values(self):
+        return [pickle.loads(str(row[0])) for row in self._query('SELECT value FROM store')]
+
+    def items(self):
+        return [(k, pickle.loads(str(v))) for k, v in self._query('SELECT key, value FROM store')]
+
+    def update(self, mapping):
+        for key, value in mapping.iteritems():
+            self[key] = value
+
+    def sync(self):
+        """
+        Commit any pending writes
+        """
+        with self._lock:
+            if self._pending > 0:
+                self._db.execute('COMMIT')
+                self._pending = 0
+
+    def compact(self):
+        """
+        Fold the write-ahead log back into the database and reclaim free pages
+        """
+        with self._lock:
+            self.sync()
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._db.execute('VACUUM')
+
+    def close(self):
+        if getattr(self, '_db', None) is None: return
+        with self._lock:
+            self.sync()
+            self._db.close()
+            self._db = None
+
+
+class GroupCommit(object):
+    """
+    Buffer writes to a store and commit them in groups.
+
+    Buffered values are written to `store` and committed once `size`
+    values are pending or `interval` seconds have passed since the
+    last commit, checked by `maybe_flush`.  Values are held by
+    reference, so each key is written with the state its object has at
+    the time of the flush.  A value is only durable once a flush has
+    returned.
+    """
+
+    def __init__(self, store, size=1, interval=None):
+        self._store    = store
+        self._size     = max(1, size)
+        self._interval = interval
+        self._buffer   = dict()
+        self._last     = time.time()
+
+    @property
+    def store(self): return self._store
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def __contains__(self, key):
+        return key in self._buffer or key in self._store
+
+    def __getitem__(self, key):
+        if key in self._buffer:
+            return self._buffer[key]
+        return self._store[key]
+
+    def __setitem__(self, key, value):
+        self._buffer[key] = value
+
+    def due(self):
+        """
+        Is a commit required by either threshold?
+        """
+        if len(self._buffer) >= self._size:
+            return True
+        if self._interval is not None and self._buffer:
+            return time.time() - self._last >= self._interval
+        return False
+
+    def maybe_flush(self):
+        if self.due():
+            return self.flush()
+        return 0
+
+    def flush(self):
+        """
+        Write and commit every buffered value.
+        Returns the number of values committed.
+        """
+        count = len(self._buffer)
+        if count > 0:
+            for key, value in self._buffer.iteritems():
+                self._store[key] = value
+            self._store.sync()
+            self._buffer.clear()
+        self._last = time.time()
+        return count
@@ -0,0 +1,72 @@
+"""
+Policies deciding which ready tasks are submitted next.
+
+When the number of outstanding tasks is limited, tasks that are ready
+(newly started or extended to their next generation) wait in a
+`Scheduler` until a slot frees up.  The `Policy` orders them: the task
+with the lowest priority is submitted first, ties are broken by the
+order in which tasks became ready.
+"""
+
+import heapq
+import itertools
+import threading
+
+
+class Policy(object):
+    def priority(self, taskable):
+        raise NotImplemented
+
+class FIFO(Policy):
+    """Submit tasks in the order they became ready"""
+
+    def priority(self, taskable):
+        return 0
+
+class LeastGenerations(Policy):
+    """Submit the tasks that have completed the fewest generations first"""
+
+    def priority(self, taskable):
+        return taskable.generation
+
+class Weighted(Policy):
+    """
+    Submit the tasks with the fewest generations relative to their
+    weight first, so that a task of weight 2 runs twice as many
+    generations as a task of weight 1.  `weights` maps digests to
+    weights, missing tasks have a weight of 1.
+    """
+
+    def __init__(self, weights=None):
+        self._weights = weights or dict()
+
+    def priority(self, taskable):
+        return taskable.generation / float(self._weights.get(taskable.digest, 1))
+
+POLICIES = dict(fifo        = FIFO,
+                generations = LeastGenerations,
+                weighted    = Weighted)
+
+
+class Scheduler(object):
+    """
+    Holds the ready tasks, with their prepared `wq.Task`, in the order given by `policy`
+    """
+
+    def __init__(self, policy=None):
+        self._policy = policy or FIFO()
+        self._heap   = list()
+        self._order  = itertools.count()
+        self._lock   = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, taskable, task):
+        entry = (self._policy.priority(taskable), next(self._order), taskable, task)
+        with self._lock: heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        """Return the (taskable, task) to submit next"""
+        with self._lock: _, _, taskable, task = heapq.heappop(self._heap)
+        return taskable, task
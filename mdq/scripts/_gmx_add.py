@@ -3,10 +3,12 @@ Add input files to a project.
 
 Each time `add` is called, the parameters and the contents
 of any provided files are hashed so that only new files are
-actually added.
+actually added. File digests are cached so that unchanged
+files are not hashed again.
 """
 
 from .. import state
+from ..digest import DigestCache
 
 import random
 
@@ -18,9 +20,15 @@ def build_parser(p):
     p.add_argument('-x', '--positions' , help='If given, use the positions from this GUAMPS vector file')
     p.add_argument('-v', '--velocities', help='If given, use the velocities from this GUAMPS vector file')
     p.add_argument('-t', '--time', type=float, default=None, help='If given, start the simulation at this time')
+    p.add_argument('-w', '--weight', type=float, default=None,
+                   help='Relative share of the workers for this simulation when running with `--schedule weighted`')
+    p.add_argument('-j', '--jobs', type=int, default=1, help='Hash up to this many files concurrently')
 
 
 def main(opts):
+    if opts.weight is not None and not opts.weight > 0:
+        raise ValueError, '--weight must be positive, not %s' % opts.weight
+
     cfg  = state.Config.load()
     if cfg.seed is not None:
         random.seed(cfg.seed)
@@ -35,8 +43,11 @@ def main(opts):
     if opts.velocities is not None: spec['v'] = opts.velocities
     if opts.time       is not None: spec['t'] = opts.time
 
-    spec.update_digest()
+    cache = DigestCache(state.DIGESTS)
+    spec.update_digest(cache=cache, jobs=opts.jobs)
+    cache.close()
     cfg.add(spec)
     cfg.seed = spec['seed']
     cfg.alias(spec.digest, opts.name)
+    if opts.weight is not None: cfg.weigh(spec.digest, opts.weight)
     cfg.write()
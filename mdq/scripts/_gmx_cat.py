@@ -1,5 +1,10 @@
 """
 Concatenate trajectory files from multiple generations of a simulation
+
+With `--incremental` only the generations completed since the last
+call are appended to the outputs, so this may be run repeatedly while
+`mdq run` is producing data. Outputs that are up to date are skipped,
+and `--jobs` concatenates several simulations concurrently.
 """
 
 from .. import state
@@ -8,17 +13,61 @@ from ..md import gmx
 from pxul.logging import logger
 
 import glob
+import itertools
+import json
 import mdprep
+import multiprocessing
 import os
+import shutil
+import time
+import traceback
 
 def build_parser(p):
     p.add_argument('-o', '--outputdir', default='sims', help='Output to here')
     p.add_argument('--xtc', action='store_true', help='Concat the .xtc files')
     p.add_argument('--trr', action='store_true', help='Concat the .trr files')
+    p.add_argument('-i', '--incremental', action='store_true',
+                   help='Only append the generations completed since the previous call')
+    p.add_argument('-j', '--jobs', default=1, type=int, help='Concatenate up to this many trajectories concurrently')
+
+
+def generations(simdir):
+    """
+    The generations found in `simdir`, in numeric order
+    """
+    gens = list()
+    for name in os.listdir(simdir):
+        if name.isdigit() and os.path.isdir(os.path.join(simdir, name)):
+            gens.append(int(name))
+    return sorted(gens)
 
+def is_complete(simdir, gen):
+    """
+    A generation is complete once its marker is written or the next generation has started
+    """
+    return os.path.exists(os.path.join(simdir, str(gen), gmx.DONE_MARKER)) \
+        or os.path.isdir(os.path.join(simdir, str(gen + 1)))
 
-def list_traj_parts(prefix, suffix):
-    return glob.glob(os.path.join(prefix, '*', '*'+suffix))
+def completed_generations(simdir):
+    """
+    The completed generations, without gaps from the first one
+    """
+    done = list()
+    for gen in generations(simdir):
+        if gen != len(done) or not is_complete(simdir, gen): break
+        done.append(gen)
+    return done
+
+def list_traj_parts(prefix, suffix, gens=None):
+    """
+    The trajectory files of the generations, each followed by those of
+    the later segments of its generation (see `gmx.segment_name`)
+    """
+    gens = generations(prefix) if gens is None else gens
+    parts = list()
+    for gen in gens:
+        parts.extend(sorted(glob.glob(os.path.join(prefix, str(gen), '*'+suffix)), key=gmx.split_segment))
+    return parts
 
 def cat_traj_parts(parts, out):
     logger.info('Writing', out, '\n' + '\n'.join(parts))
@@ -28,16 +77,143 @@ def cat(simdir, suffix, out):
     cat_traj_parts(list_traj_parts(simdir, suffix),
                    os.path.join(out, 'traj' + suffix))
 
+
+###################################################################### incremental concatenation
+
+def manifest_path(out):
+    """
+    Where the progress of the incremental concatenation into `out` is recorded
+    """
+    return out + '.mdq'
+
+def load_manifest(out):
+    path = manifest_path(out)
+    if os.path.exists(path) and os.path.exists(out):
+        with open(path) as fd:
+            return json.load(fd)
+    return dict(merged=0, size=0, time=None)
+
+def save_manifest(out, manifest):
+    path = manifest_path(out)
+    with open(path + '.tmp', 'w') as fd:
+        json.dump(manifest, fd)
+    os.rename(path + '.tmp', path)
+
+def append_file(src, dst):
+    with open(src, 'rb') as fin:
+        with open(dst, 'ab') as fout:
+            shutil.copyfileobj(fin, fout)
+
+def cat_incremental(simdir, suffix, out):
+    """
+    Append the parts of the generations completed since the last call to `out`.
+    The first frame of each part repeats the last frame of the previous
+    generation, so it is dropped.
+    Returns the number of generations appended.
+    """
+    manifest = load_manifest(out)
+    size = os.path.getsize(out) if os.path.exists(out) else 0
+    if size < manifest['size']:
+        logger.warning('Output', out, 'is shorter than recorded, rebuilding it')
+        manifest = dict(merged=0, size=0, time=None)
+    if size != manifest['size']:
+        # drop the data of an append that was interrupted
+        with open(out, 'ab') as fd: fd.truncate(manifest['size'])
+
+    new = [gen for gen in completed_generations(simdir) if gen >= manifest['merged']]
+    root, ext = os.path.splitext(out)
+    chunk = root + '.chunk' + ext
+
+    for gen in new:
+        for part in list_traj_parts(simdir, suffix, [gen]):
+            logger.info1('Appending', part, 'to', out)
+            if manifest['time'] is None:
+                if gen > 0:
+                    logger.warning('End time of generation', gen - 1, 'in', simdir,
+                                   'is unknown, the first frame of', part, 'may be repeated')
+                append_file(part, out)
+            else:
+                begin = manifest['time'] + max(1e-3, abs(manifest['time']) * 1e-6)
+                gmx.trjcat(f = part, o = chunk, b = begin)
+                append_file(chunk, out)
+                os.unlink(chunk)
+
+        marker = os.path.join(simdir, str(gen), gmx.DONE_MARKER)
+        end = gmx.read_done_marker(marker) if os.path.exists(marker) else None
+        manifest.update(merged = gen + 1, size = os.path.getsize(out), time = end)
+        save_manifest(out, manifest)
+
+    return len(new)
+
+
+def is_up_to_date(parts, out):
+    """
+    Is `out` newer than all the `parts` it is concatenated from?
+    """
+    if not os.path.exists(out): return False
+    mtime = os.path.getmtime(out)
+    return all(os.path.getmtime(part) <= mtime for part in parts)
+
+def cat_job(args):
+    """
+    Concatenate one trajectory: (simdir, suffix, out, incremental) -> (out, generations or parts, error)
+    A count of 0 means `out` was already up to date.
+    """
+    simdir, suffix, out, incremental = args
+    try:
+        with gmx.disable_gromacs_backups():
+            if incremental:
+                return out, cat_incremental(simdir, suffix, out), None
+            parts = list_traj_parts(simdir, suffix)
+            if not parts or is_up_to_date(parts, out):
+                return out, 0, None
+            cat_traj_parts(parts, out)
+            return out, len(parts), None
+    except Exception:
+        return out, None, traceback.format_exc()
+
 def main(opts):
     hashes = state.State.load().keys()
     names  = state.Config.load().aliases
     suffixes = list()
+    if opts.xtc: suffixes.append('.xtc')
+    if opts.trr: suffixes.append('.trr')
+
+    jobs = list()
     for h in  hashes:
         out = os.path.join(opts.outputdir, names[h])
         mdprep.util.ensure_dir(out)
         simdir = os.path.join(state.SIMS, h)
-        if opts.xtc: suffixes.append('.xtc')
-        if opts.trr: suffixes.append('.trr')
         for suffix in suffixes:
-            with gmx.disable_gromacs_backups():
-                cat(simdir, suffix, out)
+            jobs.append((simdir, suffix, os.path.join(out, 'traj' + suffix), opts.incremental))
+
+    pool = None
+    if opts.jobs > 1 and len(jobs) > 1:
+        pool    = multiprocessing.Pool(min(opts.jobs, len(jobs)))
+        results = pool.imap_unordered(cat_job, jobs)
+    else:
+        results = itertools.imap(cat_job, jobs)
+
+    start = time.time()
+    updated, skipped, failed = 0, 0, list()
+    try:
+        for i, (out, count, error) in enumerate(results, 1):
+            if error is not None:
+                failed.append(out)
+                logger.error('Failed to write', out, '\n' + error)
+            elif count == 0:
+                skipped += 1
+                logger.info1('Up to date', out)
+            else:
+                updated += 1
+                logger.info('Wrote', out, 'from', count, 'generations' if opts.incremental else 'parts')
+            logger.info1('Done {}/{} in {:.1f}s'.format(i, len(jobs), time.time() - start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    logger.info('Concatenated {} trajectories ({} updated, {} up to date, {} failed) in {:.1f}s'.format(
+        len(jobs), updated, skipped, len(failed), time.time() - start))
+    if failed:
+        raise RuntimeError, 'Failed to write %s' % ', '.join(failed)
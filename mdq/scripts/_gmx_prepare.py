@@ -1,14 +1,43 @@
 """
 Prepare files that have been added to the mdq project
+
+Simulations may be prepared concurrently with `--jobs`. Each is
+written to its own directory and recorded in the state as soon as it
+is ready, so an interrupted run resumes with the remaining ones.
 """
 
 from .. import state
 from ..md import gmx
 
+from pxul.logging import logger
+
+import itertools
+import multiprocessing
 import os
+import time
+import traceback
 
 def build_parser(p):
-    pass
+    p.add_argument('-j', '--jobs', default=1, type=int, help='Prepare up to this many simulations concurrently')
+
+def prepare(args):
+    """
+    Prepare a single specification: (Prepare, digest, Spec) -> (digest, Task or None, error or None)
+    """
+    prep, h, spec = args
+    try:
+        task = prep.task(
+            spec['tpr'],
+            x         = spec.get('x'),
+            v         = spec.get('v'),
+            t         = spec.get('t'),
+            outputdir = os.path.join(state.SIMS, h),
+            seed      = spec['seed'],
+            digest    = h
+            )
+        return h, task, None
+    except Exception:
+        return h, None, traceback.format_exc()
 
 def main(opts):
     cfg = state.Config.load()
@@ -16,24 +45,47 @@ def main(opts):
         picoseconds    = cfg.time,
         outputfreq     = cfg.outputfreq,
         cpus           = cfg.cpus,
+        memory         = cfg.memory,
+        disk           = cfg.disk,
         mdrun          = cfg.binary('mdrun'),
         guamps_get     = cfg.binary('guamps_get'),
         guamps_set     = cfg.binary('guamps_set'),
         keep_trajfiles = True,
+        continuation   = cfg.continuation,
+        compression    = cfg.compression,
+        compression_level = cfg.compression_level,
         )
 
-    with state.State(state.STATE) as st:
-
-        for h in cfg.sims:
-            if h in st: continue
-            spec  = cfg.sims[h]
-            st[h] = prep.task(
-                spec['tpr'],
-                x         = spec.get('x'),
-                v         = spec.get('v'),
-                t         = spec.get('t'),
-                outputdir = os.path.join(state.SIMS, h),
-                seed      = spec['seed'],
-                digest    = h
-                )
+    with state.State.load() as st:
+
+        todo = [(prep, h, cfg.sims[h]) for h in cfg.sims if h not in st]
+        if not todo:
+            logger.info('Nothing to prepare')
+            return
+
+        pool = None
+        if opts.jobs > 1:
+            pool    = multiprocessing.Pool(min(opts.jobs, len(todo)))
+            results = pool.imap_unordered(prepare, todo)
+        else:
+            results = itertools.imap(prepare, todo)
+
+        start  = time.time()
+        failed = list()
+        try:
+            for i, (h, task, error) in enumerate(results, 1):
+                if error is None:
+                    st[h] = task
+                else:
+                    failed.append(h)
+                    logger.error('Failed to prepare', cfg.aliases.get(h, h), '\n' + error)
+                elapsed = time.time() - start
+                logger.info('Prepared {}/{} ({} failed) in {:.1f}s: {:.2f} sims/s'.format(
+                    i, len(todo), len(failed), elapsed, i / max(elapsed, 1e-6)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
+    if failed:
+        raise RuntimeError, 'Failed to prepare %d simulations: %s' % (len(failed), ', '.join(failed))
@@ -5,20 +5,34 @@ An MD backend must be specified (eg, `gromacs`).
 """
 
 from .. import state
+from ..md import gmx
 from pxul.logging import logger
 
 import os.path
 
+def cpus(value):
+    return value if value == 'auto' else int(value)
+
 def build_parser(p):
     p.add_argument('backend', choices=['gromacs'], help='The backend type')
     p.add_argument('-g', '--generations', default=float('inf'), type=int,
                     help='Number of generations to run')
     p.add_argument('-t', '--time', type=int, help='Number of picoseconds to run each generation')
     p.add_argument('-o', '--outputfreq', type=float, help='Output frequency in picoseconds')
-    p.add_argument('-c', '--cpus', default=1, type=int, help='Number of CPUs to run each simulation')
+    p.add_argument('-c', '--cpus', default=1, type=cpus,
+                   help='Number of CPUs to run each simulation, or "auto" for the cores of the worker')
+    p.add_argument('--memory', type=int, help='Memory (MB) needed by each simulation')
+    p.add_argument('--disk', type=int, help='Disk (MB) needed by each simulation')
     p.add_argument('-b', '--binaries', default='binaries',
                    help='Where to find the OS and ARCH -dependent files')
     p.add_argument('-s', '--seed', default=None, help='Seed the random number generator with this value')
+    p.add_argument('-C', '--continuation', default='guamps', choices=gmx.CONTINUATIONS,
+                   help='Continue each generation by injecting the state into the .tpr (guamps) '
+                        'or from the mdrun checkpoint (checkpoint, requires GROMACS >= 4.6)')
+    p.add_argument('-z', '--compress', default=None, choices=sorted(gmx.CODECS),
+                   help='Compress the files transferred between the workers and mdq with this codec')
+    p.add_argument('-Z', '--compress-level', default=6, type=int, choices=range(1, 10),
+                   help='Compression level')
 
 def main(opts):
 
@@ -34,8 +48,13 @@ def main(opts):
         time        = opts.time,
         outputfreq  = opts.outputfreq,
         cpus        = opts.cpus,
+        memory      = opts.memory,
+        disk        = opts.disk,
         binaries    = opts.binaries,
-        seed        = opts.seed
+        seed        = opts.seed,
+        continuation= opts.continuation,
+        compression = opts.compress,
+        compression_level = opts.compress_level,
         )
 
     cfg.write()
@@ -1,4 +1,4 @@
-from .  import init, _gmx_add, _gmx_prepare, run, _gmx_cat, status
+from .  import init, _gmx_add, _gmx_prepare, run, _gmx_cat, status, migrate, perf
 from .. import state
 from .. import version
 
@@ -17,6 +17,8 @@ def getopts():
     SUBCMDS['run'] = run
     SUBCMDS['cat'] = _gmx_cat
     SUBCMDS['status']= status
+    SUBCMDS['migrate'] = migrate
+    SUBCMDS['perf'] = perf
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-v', '--verbosity', action='count', default=0, help='Increase verbosity')
@@ -0,0 +1,41 @@
+"""
+Convert a legacy shelve state store to the current format
+
+Every simulation in the legacy store is copied into the new store in a
+single transaction. Existing entries in the new store are kept unless
+`--force` is given.
+"""
+
+from .. import state
+from ..persistence import Persistent
+from pxul.logging import logger
+
+import os
+
+def build_parser(p):
+    p.add_argument('-s', '--source', default=state.LEGACY_STATE, help='The legacy shelve store')
+    p.add_argument('-d', '--dest', default=state.STATE, help='The store to write')
+    p.add_argument('-f', '--force', action='store_true', help='Overwrite entries already in the destination')
+
+
+def main(opts):
+    if not (os.path.exists(opts.source) or os.path.exists(opts.source + '.db')):
+        raise ValueError, 'Legacy store %s does not exist' % opts.source
+
+    old = Persistent(opts.source, flag='r')
+    keys = old.keys()
+    st = state.State(opts.dest, batch=len(keys) + 1)
+
+    copied = 0
+    for h in keys:
+        if h in st and not opts.force:
+            logger.info1('Skipping', h, 'already in', opts.dest)
+            continue
+        st[h] = old[h]
+        copied += 1
+
+    st.sync()
+    st.store.compact()
+    st.close()
+    old.close()
+    logger.info('Migrated', copied, 'of', len(keys), 'simulations from', opts.source, 'to', opts.dest)
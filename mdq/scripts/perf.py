@@ -0,0 +1,95 @@
+"""
+Report the performance of the simulations and of the workers
+
+The history recorded for each completed generation is summarized per
+simulation and per worker host. Each generation is compared to the
+median performance of its simulation, so that hosts running
+consistently slower than their peers are flagged.
+"""
+
+from .. import state
+from pxul.logging import logger
+
+import collections
+import json
+import sys
+
+def build_parser(p):
+    p.add_argument('-s', '--slow', default=0.75, type=float,
+                   help='Flag hosts running below this fraction of the median performance')
+    p.add_argument('-f', '--format', default='text', choices=['text', 'json'], help='Output format')
+
+
+def median(values):
+    values = sorted(values)
+    if not values: return None
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid-1] + values[mid]) / 2.
+
+def mean(values):
+    values = list(values)
+    return sum(values) / len(values) if values else None
+
+def summarize(cfg, st, slow):
+    """
+    Return per-simulation and per-host summaries of the history
+    """
+    sims  = list()
+    hosts = collections.defaultdict(lambda: dict(generations=0, execution=list(), relative=list()))
+
+    for h in st.keys():
+        history = getattr(st[h], 'history', [])
+        perf    = [r['ns_per_day'] for r in history if r.get('ns_per_day')]
+        typical = median(perf)
+        sims.append(dict(
+            name        = cfg.aliases.get(h, h),
+            digest      = h,
+            generations = len(history),
+            ns_per_day  = mean(perf),
+            execution   = mean(r['execution'] for r in history if r.get('execution') is not None),
+            ))
+        for r in history:
+            host = hosts[r.get('host') or 'unknown']
+            host['generations'] += 1
+            if r.get('execution') is not None:
+                host['execution'].append(r['execution'])
+            if r.get('ns_per_day') and typical:
+                host['relative'].append(r['ns_per_day'] / typical)
+
+    summary = list()
+    for name, host in sorted(hosts.iteritems()):
+        relative = mean(host['relative'])
+        summary.append(dict(
+            host        = name,
+            generations = host['generations'],
+            execution   = mean(host['execution']),
+            relative    = relative,
+            slow        = relative is not None and relative < slow,
+            ))
+    return sorted(sims, key=lambda r: r['name']), summary
+
+def fmt(value, spec='{:.2f}'):
+    return '-' if value is None else spec.format(value)
+
+def main(opts):
+    cfg = state.Config.load()
+    st  = state.State.load()
+    sims, hosts = summarize(cfg, st, opts.slow)
+    st.close()
+
+    if opts.format == 'json':
+        json.dump(dict(simulations=sims, hosts=hosts), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+
+    logger.info('{:<30s} {:>6s} {:>10s} {:>12s}'.format('simulation', 'gens', 'ns/day', 'runtime (s)'))
+    for r in sims:
+        logger.info('{:.<30s} {:>6d} {:>10s} {:>12s}'.format(
+            r['name'], r['generations'], fmt(r['ns_per_day']), fmt(r['execution'], '{:.0f}')))
+
+    logger.info('')
+    logger.info('{:<30s} {:>6s} {:>10s} {:>12s}'.format('host', 'gens', 'relative', 'runtime (s)'))
+    for r in hosts:
+        logger.info('{:.<30s} {:>6d} {:>10s} {:>12s}{}'.format(
+            r['host'], r['generations'], fmt(r['relative']), fmt(r['execution'], '{:.0f}'),
+            '  SLOW' if r['slow'] else ''))
@@ -1,33 +1,86 @@
+from .. import metrics
+from .. import schedule
 from .. import state
-from ..stream    import Fount, ResumeTaskStream, GenerationalWorkQueueStream, Sink
-from ..workqueue import MkWorkQueue
+from ..persistence import Store
+from ..executor  import WorkQueueExecutor, LocalExecutor
+from ..stream    import Fount, ResumeTaskStream, GenerationalWorkQueueStream, Sink, Speculation
 
 import argparse
+import multiprocessing
+import signal
+import sys
 
 
 def build_parser(p):
+    p.add_argument('-L', '--local', default=None, type=int, nargs='?', const=0, metavar='WORKERS',
+                   help='Run the tasks on this machine instead of Work Queue workers, '
+                        'with as many at once as fit the CPUs given the CPUs per simulation unless given')
     p.add_argument('-p', '--port', default=0, type=int, help='Work Queue port')
     p.add_argument('-n', '--name', help='Specify a name to register on the catalog server')
-    p.add_argument('-r', '--replicate', default=1, type=int, help='Task replication')
+    p.add_argument('-k', '--chain', default=1, type=int,
+                   help='Run up to this many generations back to back in each task')
+    p.add_argument('-S', '--schedule', default=None, choices=sorted(schedule.POLICIES),
+                   help='Queue ready simulations until the window (--max-inflight, --per-worker) has room '
+                        'and submit them in this order (default: resubmit as soon as a generation completes)')
+    p.add_argument('--no-locality', dest='locality', action='store_false',
+                   help='Do not prefer the worker that ran the previous generation of a simulation')
+    p.add_argument('-r', '--replicate', default=1, type=int,
+                   help='Run straggling tasks as up to this many copies, the first to finish is used (1 to disable)')
+    p.add_argument('--straggler', default=2.0, type=float,
+                   help='Tasks straggle once outstanding this many times longer than the median task')
+    p.add_argument('--replicate-budget', default=0.1, type=float,
+                   help='Stop replicating while the time lost to cancelled copies exceeds this fraction of the total')
+    p.add_argument('--retries', default=3, type=int,
+                   help='Submit a failed task again up to this many times, after which it waits for the next run')
+    p.add_argument('--retry-backoff', default=30, type=float,
+                   help='Seconds to wait before submitting a failed task again, doubling with each failure')
+    p.add_argument('--blacklist', default=3, type=int,
+                   help='Stop sending tasks to a worker once this many tasks failed on it in a row (0 to never)')
     p.add_argument('-d', '--debug', action='store_true', help='Turn on debugging information')
     p.add_argument('-t', '--timeout', default=1, type=int, help='Timeout in seconds when waiting for a task')
     p.add_argument('-l', '--logfile', default=None, help='Write the workqueue log to this file')
+    p.add_argument('-B', '--persist-batch', default=32, type=int,
+                   help='Commit completed tasks to the state store in groups of this size')
+    p.add_argument('-I', '--persist-interval', default=30, type=float,
+                   help='Commit completed tasks at least this often (seconds)')
+    p.add_argument('--threaded', action='store_true',
+                   help='Persist and resubmit completed tasks on a separate thread from the one servicing the queue')
+    p.add_argument('-m', '--max-inflight', default=0, type=int,
+                   help='Maximum number of simulations submitted at once (0 for no limit)')
+    p.add_argument('-w', '--per-worker', default=0, type=float,
+                   help='Limit submitted simulations to this many per connected worker (0 for no limit)')
+    p.add_argument('-W', '--walltime', default=0, type=float,
+                   help='Adapt the length of each generation to run for about this many seconds, '
+                        'which should be below the time workers are available for (0 to keep the configured length)')
+    p.add_argument('-s', '--segment', default=0, type=float, metavar='HOURS',
+                   help='Stop mdrun after this many hours and continue the generation from its checkpoint '
+                        'in another task, so evicted workers lose at most this much (checkpoint continuation only, not with --chain)')
+    p.add_argument('-M', '--metrics', default=None, help='Periodically write metrics of the master as JSON to this file')
+    p.add_argument('--metrics-port', default=None, type=int, help='Serve metrics as JSON on this port of localhost')
+    p.add_argument('--metrics-interval', default=10, type=float, help='Seconds between writes of the metrics file')
 
 
 
+def exit_on_signal(signum, frame):
+    # raise so that pending state is committed as the stack unwinds
+    sys.exit(128 + signum)
+
+
 class TaskFount(Fount):
     def set_state(self, state):
         self._state = state
 
     def generate(self):
-        return iter(self._state.values())
-
-def main(opts):
+        # load each task only when it is about to be submitted
+        for h in self._state.keys():
+            yield self._state[h]
 
+def mk_workqueue(opts):
+    # only needs CCTools when running on Work Queue workers
+    from ..workqueue import MkWorkQueue
     mkq = (
         MkWorkQueue()
         .port(opts.port)
-        .replicate(opts.replicate)
         )
     if opts.name: mkq.catalog(True).name(opts.name)
     if opts.debug: mkq.debug_all()
@@ -37,15 +90,68 @@ def main(opts):
         # +FIXME: should be moved to pwq
         with open(opts.logfile, 'a') as fd: fd.write('#')
 
-    q = mkq()
+    return WorkQueueExecutor(mkq())
+
+def mk_local(opts, cfg):
+    # with 'auto' cpus, each simulation uses all the cores
+    cpus = multiprocessing.cpu_count() if cfg.cpus == 'auto' else cfg.cpus
+    workers = opts.local or max(1, multiprocessing.cpu_count() // max(1, cpus))
+    return LocalExecutor(workers=workers)
+
+def main(opts):
+
+    signal.signal(signal.SIGTERM, exit_on_signal)
+
+    exporters = list()
+    if opts.metrics:
+        exporters.append(metrics.FileExporter(opts.metrics, interval=opts.metrics_interval).start())
+    if opts.metrics_port is not None:
+        exporters.append(metrics.HTTPExporter(opts.metrics_port).start())
+
+    speculation = None
+    if opts.replicate > 1:
+        speculation = Speculation(factor=opts.straggler, replicas=opts.replicate - 1,
+                                  budget=opts.replicate_budget)
 
     cfg = state.Config.load()
-    with state.State.load() as st:
+    if opts.segment and cfg.continuation != 'checkpoint':
+        raise ValueError, '--segment requires checkpoint continuation (mdq init --continuation checkpoint)'
+    if opts.segment and opts.chain > 1:
+        raise ValueError, '--segment cannot be combined with --chain: chained generations are not segmented'
+    q = mk_workqueue(opts) if opts.local is None else mk_local(opts, cfg)
+
+    scheduler = None
+    if opts.schedule == 'weighted':
+        scheduler = schedule.Scheduler(schedule.Weighted(cfg.weights))
+    elif opts.schedule is not None:
+        scheduler = schedule.Scheduler(schedule.POLICIES[opts.schedule]())
+
+    with state.State.load(batch=opts.persist_batch) as st:
         fount = TaskFount()
         fount.set_state(st)
         persist = ResumeTaskStream(fount, st.store)
         submit = GenerationalWorkQueueStream(q, persist, timeout=opts.timeout,
                                              persist_to=st.store,
-                                             generations=cfg.generations)
+                                             persist_batch=opts.persist_batch,
+                                             persist_interval=opts.persist_interval,
+                                             threaded=opts.threaded,
+                                             max_inflight=opts.max_inflight,
+                                             per_worker=opts.per_worker,
+                                             progress_to=Store(state.PROGRESS, batch=opts.persist_batch),
+                                             speculation=speculation,
+                                             scheduler=scheduler,
+                                             locality=opts.locality,
+                                             retries=opts.retries,
+                                             backoff=opts.retry_backoff,
+                                             blacklist=opts.blacklist,
+                                             generations=cfg.generations,
+                                             walltime=opts.walltime,
+                                             chain=opts.chain,
+                                             segment=opts.segment)
         sink = Sink(submit)
-        sink()
+        try:
+            sink()
+        finally:
+            for exporter in exporters:
+                exporter.stop()
+            q.shutdown()
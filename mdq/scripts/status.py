@@ -1,22 +1,125 @@
 """
 Summarize the progress of the simulations
+
+The progress index maintained by `mdq run` is used when available,
+the generations of the simulations it does not cover are read from the full state.
 """
 
 from .. import state
+from ..persistence import Store
 from pxul.logging import logger
 
+import csv
+import json
+import os
+import sys
+import time
+
+FIELDS = ['name', 'digest', 'generation', 'generations', 'segments', 'state',
+          'updated', 'walltime', 'ns_per_day']
+
 def build_parser(p):
-    pass
+    p.add_argument('-f', '--format', default='text', choices=['text', 'json', 'csv'],
+                   help='Output format')
+
+
+def ns_per_day(picoseconds, seconds):
+    """
+    The simulation rate of running `picoseconds` in `seconds` of wall time
+    """
+    if not picoseconds or not seconds: return None
+    return picoseconds / 1000. * 86400. / seconds
+
+def load_records(cfg):
+    """
+    Return a dict of digest -> progress record for every simulation
+    """
+    records = dict()
+    if os.path.exists(state.PROGRESS):
+        index = Store(state.PROGRESS, flag='r')
+        records.update(index.items())
+        index.close()
+
+    # the index only covers the simulations submitted since it was created
+    missing = [h for h in cfg.sims if h not in records]
+    if missing:
+        logger.info1('Reading', len(missing), 'simulations missing from the progress index from', state.STATE)
+        # not yet prepared simulations have not started a generation
+        records.update((h, dict(generation=-1)) for h in missing)
+        if os.path.exists(state.STATE):
+            st = state.State.load()
+            for h in missing:
+                if h in st: records[h]['generation'] = st[h].generation
+            st.close()
+    return records
 
+def summarize(cfg, records):
+    """
+    Return the per-simulation rows and the aggregate throughput
+    """
+    rows = list()
+    for h in sorted(records, key=lambda h: cfg.aliases.get(h, h)):
+        record = records[h]
+        rows.append(dict(
+            name        = cfg.aliases.get(h, h),
+            digest      = h,
+            generation  = record['generation'] + 1,
+            generations = None if cfg.generations == float('inf') else cfg.generations,
+            segments    = record.get('segments', 0),
+            state       = record.get('state'),
+            updated     = record.get('updated'),
+            walltime    = record.get('walltime'),
+            ns_per_day  = record.get('ns_per_day') or ns_per_day(
+                (cfg.time or 0) * record.get('task_generations', 1), record.get('walltime')),
+            ))
+
+    completed = sum(r.get('completed', 0) for r in records.values())
+    started   = [r['started'] for r in records.values() if 'started' in r]
+    updated   = [r['updated'] for r in records.values() if 'updated' in r]
+    hours     = (max(updated) - min(started)) / 3600. if started and updated else None
+    rates     = [r['ns_per_day'] for r in rows if r['ns_per_day'] is not None and r['state'] == 'running']
+    total = dict(
+        simulations          = len(rows),
+        running              = sum(1 for r in rows if r['state'] == 'running'),
+        generations_complete = completed,
+        generations_per_hour = completed / hours if hours else None,
+        ns_per_day           = sum(rates) if rates else None,
+        ns_per_day_per_sim   = sum(rates) / len(rates) if rates else None,
+        )
+    return rows, total
+
+def fmt(value, spec='{:.2f}'):
+    return '-' if value is None else spec.format(value)
 
 def main(opts):
     cfg = state.Config.load()
-    st  = state.State.load()
+    rows, total = summarize(cfg, load_records(cfg))
 
-    for h in sorted(st.keys()):
-        logger.info('{:.<30s} {} / {}'.format(
-            cfg.aliases[h],
-            st[h].generation + 1,
-            cfg.generations,
+    if opts.format == 'json':
+        json.dump(dict(simulations=rows, total=total), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    elif opts.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    else:
+        now = time.time()
+        for row in rows:
+            logger.info('{:.<30s} {} / {} {:<8s} {:>10s} ns/day  updated {}s ago{}'.format(
+                row['name'],
+                row['generation'],
+                fmt(row['generations'], '{}'),
+                row['state'] or '-',
+                fmt(row['ns_per_day']),
+                fmt(now - row['updated'] if row['updated'] else None, '{:.0f}'),
+                # the generation is continued from the checkpoints of the segments that stopped early
+                ', segment %d' % (row['segments'] + 1) if row['segments'] else '',
+                )
             )
-        )
+        logger.info('{} simulations, {} running: {} generations complete, {} generations/hour, '
+                    '{} ns/day total, {} ns/day per simulation'.format(
+                        total['simulations'], total['running'], total['generations_complete'],
+                        fmt(total['generations_per_hour']), fmt(total['ns_per_day']),
+                        fmt(total['ns_per_day_per_sim'])))
@@ -2,7 +2,8 @@
 from pxul.logging import logger
 from pxul.StringIO import StringIO
 
-from .persistence import Persistent
+from .persistence import Persistent, Store
+from .digest import DigestCache
 
 import hashlib
 import os
@@ -10,7 +11,10 @@ import os
 DOT_DIR = '.mdq'
 CONFIG = os.path.join(DOT_DIR, 'config')
 SIMS = os.path.join(DOT_DIR, 'sims')
-STATE = os.path.join(DOT_DIR, 'state')
+STATE = os.path.join(DOT_DIR, 'state.sqlite')
+DIGESTS = os.path.join(DOT_DIR, 'digests.sqlite')
+PROGRESS = os.path.join(DOT_DIR, 'progress.sqlite') # digest -> progress record, see WorkQueueStream._track
+LEGACY_STATE = os.path.join(DOT_DIR, 'state') # shelve store used before `mdq migrate`
 
 def to_yaml_sio(sio, obj):
     if hasattr(obj, 'to_yaml_sio'):
@@ -45,16 +49,6 @@ class CADict(object):
 
 
 
-def hash_file(hasher, path, size=32*1024*1024):
-    """
-    Hash the contents of the file given by `path`, reading at most `size` bytes at a time
-    """
-    with open(path, 'rb') as fd:
-        while True:
-            data = fd.read(size)
-            if data == '': break
-            hasher.update(data)
-
 class Spec(dict):
     """:: name -> str """
 
@@ -62,14 +56,22 @@ class Spec(dict):
         super(Spec, self).__init__(*args, **kws)
         self._digest = None
 
-    def update_digest(self):
+    def update_digest(self, cache=None, jobs=1):
+        """
+        Compute the digest from the parameters and the contents of any files they name.
+        File digests are looked up in (and added to) the `cache` if given,
+        hashing up to `jobs` files concurrently.
+        """
+        cache = cache if cache is not None else DigestCache()
+        # the fields are hashed in the order of earlier versions so that
+        # the digests of specifications without files are unchanged
+        objs  = self.keys() + self.values()
+        paths = [str(obj) for obj in objs if os.path.isfile(str(obj))]
+        files = cache.digests(paths, jobs=jobs)
+
         h = hashlib.sha256()
-        for obj in self.keys() + self.values():
-            if os.path.exists(str(obj)):
-                hash_file(h, str(obj))
-            else:
-                data = repr(obj)
-            h.update(data)
+        for obj in objs:
+            h.update(files.get(str(obj), repr(obj)))
         self._digest = h.hexdigest()
 
     @property
@@ -84,6 +86,19 @@ class Spec(dict):
             return sio.getvalue().strip()
 
 class Config(object):
+
+    # the settings that may be changed by `update`
+    ATTRIBUTES = ('backend', 'generations', 'time', 'outputfreq', 'cpus', 'memory', 'disk',
+                  'binaries', 'seed', 'continuation', 'compression', 'compression_level')
+
+    # defaults for attributes added after configurations may have been written
+    continuation = 'guamps'
+    compression  = None
+    compression_level = 6
+    weights      = None
+    memory       = None
+    disk         = None
+
     def __init__(self,
                  backend='gromacs',
                  generations=float('inf'),
@@ -91,21 +106,32 @@ class Config(object):
                  outputfreq=None,
                  cpus=1,
                  binaries=None,
-                 seed=19):
+                 seed=19,
+                 continuation='guamps',
+                 compression=None,
+                 compression_level=6,
+                 memory=None,
+                 disk=None):
 
         self.backend    = backend
         self.sims       = CADict()
         self.generations= generations
         self.time       = time
         self.outputfreq = outputfreq
-        self.cpus       = cpus
+        self.cpus       = cpus # or 'auto'
+        self.memory     = memory # MB
+        self.disk       = disk   # MB
         self.binaries   = binaries
         self.seed       = seed
+        self.continuation = continuation
+        self.compression  = compression
+        self.compression_level = compression_level
         self.aliases    = dict() # digest -> string
+        self.weights    = dict() # digest -> float, see mdq.schedule.Weighted
 
     def update(self, **kws):
         for key, val in kws.iteritems():
-            if key not in self.__dict__: raise ValueError, 'Unexpected attribute %s = %s' % (key, val)
+            if key not in self.ATTRIBUTES: raise ValueError, 'Unexpected attribute %s = %s' % (key, val)
             setattr(self, key, val)
 
     def add(self, spec):
@@ -115,6 +141,11 @@ class Config(object):
     def alias(self, digest, string):
         self.aliases[digest] = string
 
+    def weigh(self, digest, weight):
+        if not weight > 0: raise ValueError, 'Weights must be positive, not %s' % weight
+        if self.weights is None: self.weights = dict()
+        self.weights[digest] = weight
+
     def binary(self, name):
         """
         Return the path to the binary for the Tasks $OS and $ARCH
@@ -149,8 +180,8 @@ class Config(object):
         return c
 
 class State(object):
-    def __init__(self, path):
-        self._p = Persistent(path)
+    def __init__(self, path, batch=1):
+        self._p = Store(path, batch=batch)
 
     def __setitem__(self, key, obj): self._p[key] = obj
 
@@ -171,9 +202,17 @@ class State(object):
     @property
     def store(self): return self._p
 
+    def sync(self): self._p.sync()
+
+    def close(self): self._p.close()
+
     @classmethod
-    def load(cls, path=STATE):
-        return cls(path)
+    def load(cls, path=STATE, batch=1):
+        legacy = os.path.exists(LEGACY_STATE) or os.path.exists(LEGACY_STATE + '.db')
+        if not os.path.exists(path) and legacy:
+            raise ValueError, 'Found a legacy state store at %s but no %s: run `mdq migrate` to convert it' % (
+                LEGACY_STATE, path)
+        return cls(path, batch=batch)
 
 
 
@@ -1,11 +1,117 @@
 from pxul.logging import logger
 
-import work_queue as ccl
+from . import metrics
+from .persistence import GroupCommit
 
+import Queue
 import collections
+import heapq
+import itertools
+import sys
+import threading
+import time
 import uuid
 
 
+SUBMITTED     = metrics.registry.counter('tasks_submitted', 'Tasks submitted to the queue')
+COMPLETED     = metrics.registry.counter('tasks_completed', 'Tasks received from the queue')
+RESUBMISSIONS = metrics.registry.counter('resubmissions', 'Tasks extended and submitted again')
+TRANSFERRED   = metrics.registry.counter('transfer_bytes', 'Bytes transferred to and from workers')
+PERSISTED     = metrics.registry.counter('tasks_persisted', 'Tasks committed to the state store')
+QUEUE_DEPTH   = metrics.registry.gauge('queue_depth', 'Tasks in the queue')
+OUTSTANDING   = metrics.registry.gauge('outstanding', 'Tasks submitted or being prepared for resubmission')
+LATENCY       = metrics.registry.histogram('task_latency_seconds', 'Time from submission to result')
+RUNTIME       = metrics.registry.histogram('task_runtime_seconds', 'Execution time of a task on the worker')
+PERSIST_TIME  = metrics.registry.histogram('persist_seconds', 'Time to commit a group of tasks')
+TURNAROUND    = metrics.registry.histogram('turnaround_seconds', 'Time from a result to the resubmission of the task')
+REPLICAS      = metrics.registry.counter('replicas_submitted', 'Replicas submitted for straggling tasks')
+REPLICA_WINS  = metrics.registry.counter('replica_wins', 'Straggling tasks completed first by a replica')
+REPLICA_WASTE = metrics.registry.counter('replica_wasted_seconds', 'Time spent by cancelled copies of replicated tasks')
+CACHE_HITS    = metrics.registry.counter('cache_hits', 'Cached inputs already on the worker a task ran on')
+CACHE_MISSES  = metrics.registry.counter('cache_misses', 'Cached inputs transferred to the worker a task ran on')
+CACHE_SAVED   = metrics.registry.counter('cache_bytes_avoided', 'Bytes of cached inputs not transferred again')
+CACHE_RATE    = metrics.registry.gauge('cache_hit_rate', 'Fraction of cached inputs already on the worker')
+FAILURES      = metrics.registry.counter('tasks_failed', 'Tasks returned without valid outputs')
+RETRIES       = metrics.registry.counter('retries', 'Failed tasks submitted again')
+ABANDONED     = metrics.registry.counter('tasks_abandoned', 'Tasks that failed more often than allowed')
+BLACKLISTED   = metrics.registry.counter('hosts_blacklisted', 'Workers that no longer receive tasks')
+UTILIZATION   = metrics.registry.gauge('core_utilization', 'Fraction of the cores of the workers committed to tasks')
+
+# seconds between the polls of the queue while the handler thread is busy
+POLL = 1
+
+
+def result_attr(result, name, default=None):
+    """
+    Return an attribute of a task returned by the queue, which may not be
+    provided by every version of Work Queue
+    """
+    return getattr(result, name, default)
+
+
+class Speculation(object):
+    """
+    Decides which tasks to replicate.
+
+    A task straggles once it has been outstanding for `factor` times the
+    median latency of the last `window` results, which needs at least
+    `samples` results.  A straggler gets at most `replicas` extra copies,
+    and copies are only started while the time lost to cancelled copies
+    stays below `budget` times the latency of the tasks received.
+    """
+
+    def __init__(self, factor=2.0, replicas=1, budget=0.1, samples=10, window=1000):
+        self.factor   = factor
+        self.replicas = replicas
+        self.budget   = budget
+        self.samples  = samples
+        self._latency = collections.deque(maxlen=window)
+        self.useful   = 0.0 # seconds from submission to result of the received copies
+        self.wasted   = 0.0 # seconds from submission to cancellation of the other copies
+        self.launched = 0
+        self.wins     = 0   # results received from a replica before the original
+        self.overrun  = 0.0 # seconds the originals had run beyond the median when a replica won
+
+    def median(self):
+        if len(self._latency) < self.samples: return None
+        values = sorted(self._latency)
+        return values[len(values) // 2]
+
+    def threshold(self):
+        """Seconds after which a task straggles, or None while too few results were observed"""
+        median = self.median()
+        return None if median is None else self.factor * median
+
+    def affordable(self):
+        return self.wasted <= self.budget * self.useful
+
+    def received(self, latency, original=None):
+        """
+        Account for a result received `latency` seconds after its
+        submission.  If it came from a replica, `original` is how long
+        the original copy had been running.
+        """
+        median = self.median()
+        self._latency.append(latency)
+        self.useful += latency
+        if original is not None:
+            self.wins += 1
+            if median is not None:
+                self.overrun += max(0.0, original - median)
+            REPLICA_WINS.inc()
+
+    def cancelled(self, elapsed):
+        self.wasted += elapsed
+        REPLICA_WASTE.inc(elapsed)
+
+    def report(self):
+        if self.launched <= 0: return
+        logger.info('%-15s' % 'Replication',
+                    '%d replicas, %d won' % (self.launched, self.wins),
+                    'cutting short stragglers %.0fs past the median,' % self.overrun,
+                    'wasting %.0fs (%.1f%% of %.0fs)' % (self.wasted, 100 * self.wasted / max(self.useful, 1), self.useful))
+
+
 class Unique(object):
     def __init__(self):
         self._uuid = uuid.uuid1()
@@ -86,13 +192,107 @@ class ResumeTaskStream(IPersistableTaskStream):
 class WorkQueueStream(Stream):
     """
     WorkQueueStream :: Persistable t, Task t => Stream t -> Stream t
+
+    Tasks are run by `q`, an `mdq.executor.Executor`.
+
+    Completed tasks are persisted to `persist_to` in groups of
+    `persist_batch`, or every `persist_interval` seconds.  Pending
+    writes are committed before a task is passed downstream and when
+    the stream stops, including by an exception or signal.
+
+    If `threaded`, completed tasks are persisted and processed (eg
+    extended and prepared for resubmission) on a separate handler
+    thread, so that the calling thread only services the queue.
+
+    Tasks are pulled from upstream lazily: at most `max_inflight`
+    tasks are outstanding at any time.  If `per_worker` is given the
+    window is also scaled to that many tasks per connected worker.
+    Resubmissions of a completed task reuse its slot.
+
+    If `progress_to` is given, a small record of the progress of each
+    task (see `_track`) is kept there, committed like the tasks.
+
+    If `speculation` (a `Speculation`) is given, straggling tasks are
+    replicated while no task is waiting for a worker.  The first copy
+    to return is used and the others are cancelled.
+
+    If `locality`, the next generation of a task prefers the worker
+    that ran the previous one, which already caches its inputs.  The
+    inputs cached by each worker are estimated from the tasks it ran
+    to report the cache hit rate.  Neither applies to executors whose
+    workers do not cache inputs (`supports_locality` is false).
+
+    If a `scheduler` (see `mdq.schedule`) is given, ready tasks,
+    including resubmissions and the next task from upstream, wait there
+    for a free slot in the window and are submitted in the order of its
+    policy.
+
+    Returned tasks are validated before they are persisted: the task and
+    its command must have succeeded, and tasks providing a `.validate`
+    method check their outputs.  A failed task is submitted again after
+    `backoff` seconds, doubling with each failure, up to `retries` times,
+    after which it is abandoned until the next run.  Workers on which
+    `blacklist` tasks fail in a row no longer receive tasks (0 to never
+    blacklist).
     """
-    def __init__(self, q, source, timeout=5, persist_to=None):
+    def __init__(self, q, source, timeout=5, persist_to=None,
+                 persist_batch=1, persist_interval=None, threaded=False,
+                 max_inflight=None, per_worker=None, progress_to=None,
+                 speculation=None, scheduler=None, locality=False,
+                 retries=3, backoff=30, blacklist=3):
         super(WorkQueueStream, self).__init__(source)
         self._q = q
         self._timeout = timeout
         self._table = dict() # Task t => uuid -> t
         self._persist_to = persist_to
+        self._commit = None
+        if persist_to is not None:
+            self._commit = GroupCommit(persist_to, size=persist_batch, interval=persist_interval)
+
+        self._threaded   = threaded
+        self._ready      = Queue.Queue() # (t, wq.Task) prepared for submission
+        self._results    = Queue.Queue() # (t, result) received from the queue
+        self._output     = Queue.Queue() # t to pass downstream
+        self._wake       = threading.Event()
+        self._busy       = 0             # received but not yet handled
+        self._busy_lock  = threading.Lock()
+
+        self._max_inflight = max_inflight or None
+        self._per_worker   = per_worker or None
+        self._source       = None        # iterator over upstream, once started
+
+        self._progress = None
+        self._progress_lock = threading.Lock() # progress is tracked from both threads when `threaded`
+        if progress_to is not None:
+            self._progress = GroupCommit(progress_to, size=persist_batch, interval=persist_interval)
+
+        self._submitted  = dict()        # wq.Task uuid -> time of submission
+        self._received   = dict()        # uuid -> time the last result was received
+        self._turnaround = [0, 0.0]      # count, total seconds from result to resubmission
+
+        self._speculation = speculation
+        self._copies     = dict()        # uuid -> [wq.Task uuid], the original first
+        self._taskids    = dict()        # wq.Task uuid -> Work Queue task id
+
+        self._scheduler  = scheduler
+
+        self._caching    = getattr(q, 'supports_locality', False) # workers cache inputs
+        self._locality   = locality and self._caching
+        self._hosts      = dict()        # uuid -> worker that ran the previous generation
+        self._cached     = dict()        # wq.Task uuid -> [(remote name, bytes)] of its cached inputs
+        self._warm       = collections.defaultdict(set) # worker -> remote names it caches
+        self._fresh      = set()         # uuids of the upstream tasks in the scheduler
+
+        self._utilization = [None, 0.0, 0.0] # time of the last sample, busy core-seconds, core-seconds
+
+        self._retries    = retries
+        self._backoff    = backoff
+        self._blacklist  = blacklist
+        self._failures   = collections.defaultdict(int) # uuid -> failures
+        self._faults     = collections.defaultdict(int) # worker -> failures in a row
+        self._blacklisted = set()
+        self._delayed    = list()        # heap of (time, order, t) to retry
+        self._order      = itertools.count()
 
     @property
     def wq(self): return self._q
@@ -103,55 +303,488 @@ class WorkQueueStream(Stream):
         """
         return len(self._table)
 
+    def outstanding(self):
+        """
+        Returns the number of tasks submitted, or being prepared for resubmission
+        """
+        return len(self._copies) + self._ready.qsize() + self._busy + len(self._delayed)
+
+    def window(self):
+        """
+        Returns the maximum number of outstanding tasks, or None if unbounded
+        """
+        limit = self._max_inflight
+        if self._per_worker is not None:
+            workers = self.wq.stats.total_workers_connected
+            scaled  = max(1, int(self._per_worker * workers))
+            limit   = scaled if limit is None else min(limit, scaled)
+        return limit
+
+    def _fill(self):
+        """
+        Submit tasks from upstream until the window is full or upstream is exhausted
+        """
+        if self._scheduler is not None: return self._schedule()
+        if self._source is None: return
+        limit = self.window()
+        while limit is None or self.outstanding() < limit:
+            try:
+                t = next(self._source)
+            except StopIteration:
+                self._source = None
+                break
+            self.submit(t)
+            if self._threaded: self._submit_ready()
+
+    def _schedule(self):
+        """
+        Submit the ready tasks chosen by the scheduler until the window is full
+        """
+        limit = self.window()
+        while limit is None or self.outstanding() < limit:
+            # the next upstream task competes with the resubmissions
+            if self._source is not None and not self._fresh:
+                try:
+                    t = next(self._source)
+                except StopIteration:
+                    self._source = None
+                else:
+                    self._fresh.add(t.uuid)
+                    self.submit(t)
+            if not len(self._scheduler): break
+            taskable, task = self._scheduler.pop()
+            self._fresh.discard(taskable.uuid)
+            self._submit(taskable, task)
+
     def _persist(self, taskable):
-        if self._persist_to is not None:
+        if self._commit is not None:
             logger.debug('%-15s' % 'Persisting', taskable.uuid)
-            run_stream((lambda: (yield taskable))(),
-                       PersistTaskStream,
-                       extra_args = [self._persist_to])
+            self._commit[taskable.digest] = taskable
+
+    def _flush(self, force=True):
+        if self._commit is None: return
+        start = time.time()
+        count = self._commit.flush() if force else self._commit.maybe_flush()
+        if count > 0:
+            PERSIST_TIME.observe(time.time() - start)
+            PERSISTED.inc(count)
+            logger.info1('%-15s' % 'Committed', count, 'tasks')
+
+    def _track(self, taskable, state):
+        """
+        Update the progress record of `taskable`, which holds:
+          generation: the current generation
+          state     : 'running' once submitted, 'done' once received,
+                      'failed' once abandoned
+          updated   : time of the last update
+          submitted : time of the last submission
+          started   : time of the first submission
+          walltime  : seconds from submission to result of the last generation
+          elapsed   : total walltime over all generations
+          completed : number of generations completed
+          segments  : tasks of the current generation that stopped early, if the task reports it
+          ns_per_day: the performance of the last generation, if the task reports it
+        """
+        if self._progress is None: return
+        with self._progress_lock:
+            self._update_progress(taskable, state)
+
+    def _update_progress(self, taskable, state):
+        key = taskable.digest
+        now = time.time()
+        if key in self._progress:
+            record = self._progress[key]
+        else:
+            record = dict(started=now, submitted=now, walltime=None, elapsed=0.0, completed=0)
+        generation = getattr(taskable, 'generation', None)
+        if state == 'done':
+            # a chained task completes the generations from the one it was submitted at
+            first = record.get('generation')
+            completed = 0 if getattr(taskable, 'partial', False) else \
+                        1 + (generation - first if None not in (generation, first) else 0)
+            record['completed'] += completed
+            record['task_generations'] = completed # by the last task, see mdq status
+        record.update(generation=generation, state=state, updated=now)
+        if state == 'running':
+            record['submitted'] = now
+        elif state == 'done':
+            record['walltime']   = now - record['submitted']
+            record['elapsed']   += record['walltime']
+            record['ns_per_day'] = getattr(taskable, 'ns_per_day', None)
+            record['segments']   = getattr(taskable, 'segments', 0)
+        self._progress[key] = record
+
+    def _flush_progress(self, force=True):
+        if self._progress is None: return
+        with self._progress_lock:
+            if force: self._progress.flush()
+            else: self._progress.maybe_flush()
 
     def submit(self, taskable):
         logger.debug('%-15s' % 'Submitting', taskable.uuid)
         task = taskable.to_task()
+        if self._scheduler is not None:
+            self._scheduler.push(taskable, task)
+            self._wake.set()
+        elif self._threaded:
+            self._ready.put((taskable, task))
+            self._wake.set()
+        else:
+            return self._submit(taskable, task)
+
+    def _submit(self, taskable, task):
+        if taskable.uuid in self._received:
+            delay = time.time() - self._received.pop(taskable.uuid)
+            self._turnaround[0] += 1
+            self._turnaround[1] += delay
+            TURNAROUND.observe(delay)
+            logger.info1('%-15s' % 'Turnaround', taskable.uuid, '%.3fs' % delay)
+        host = self._hosts.pop(taskable.uuid, None)
+        if self._locality and host:
+            task.specify_preferred_host(host)
+        self._cached[task.uuid] = task.cached()
         self._table[task.uuid] = taskable
-        return self.wq.submit(task)
+        self._submitted[task.uuid] = time.time()
+        self._copies[taskable.uuid] = [task.uuid]
+        self._track(taskable, 'running')
+        SUBMITTED.inc()
+        taskid = self.wq.submit(task)
+        self._taskids[task.uuid] = taskid
+        return taskid
+
+    def _speculate(self):
+        """
+        Submit replicas of the straggling tasks if workers would otherwise idle
+        """
+        spec = self._speculation
+        if spec is None or self.wq.stats.tasks_waiting > 0: return
+        threshold = spec.threshold()
+        if threshold is None: return
+        now = time.time()
+        for copies in self._copies.values():
+            if len(copies) > spec.replicas or not spec.affordable(): continue
+            elapsed = now - self._submitted[copies[0]]
+            if elapsed < threshold: continue
+            taskable = self._table[copies[0]]
+            task = taskable.to_task()
+            logger.info('%-15s' % 'Replicating', taskable.uuid, 'after %.0fs' % elapsed)
+            self._cached[task.uuid] = task.cached()
+            self._table[task.uuid] = taskable
+            self._submitted[task.uuid] = now
+            self._taskids[task.uuid] = self.wq.submit(task)
+            copies.append(task.uuid)
+            spec.launched += 1
+            REPLICAS.inc()
+
+    def _settle(self, taskable, result):
+        """
+        Cancel the other copies of `taskable` once `result` was received.
+        Returns how long the original copy had been running if a replica
+        won, else None.
+        """
+        copies = self._copies.pop(taskable.uuid, [result.uuid])
+        self._taskids.pop(result.uuid, None)
+        now = time.time()
+        original = None
+        if copies[0] != result.uuid:
+            original = now - self._submitted[copies[0]]
+        for other in copies:
+            if other == result.uuid: continue
+            logger.info1('%-15s' % 'Cancelling', 'copy', other, 'of', taskable.uuid)
+            self.wq.cancel(self._taskids.pop(other))
+            del self._table[other]
+            del self._cached[other]
+            elapsed = now - self._submitted.pop(other)
+            if self._speculation is not None:
+                self._speculation.cancelled(elapsed)
+        return original
+
+    def _validate(self, taskable, result):
+        """
+        Return what is wrong with `result`, or None if `taskable` may be updated from it
+        """
+        status = result_attr(result, 'result', 0)
+        if status:
+            return 'task failed with result %s' % status
+        code = result_attr(result, 'return_status', 0)
+        if code:
+            return 'command exited with status %s' % code
+        if hasattr(taskable, 'validate'):
+            return taskable.validate(result)
+
+    def _failed(self, taskable, result, problem):
+        """
+        Drop the failed copy `result` of `taskable`.  Unless another copy
+        is still running, retry the task after a backoff or abandon it.
+        """
+        FAILURES.inc()
+        host = result_attr(result, 'hostname')
+        logger.warning('%-15s' % 'Failed', taskable.uuid, 'on', host, ':', problem)
+        del self._table[result.uuid]
+        self._submitted.pop(result.uuid, None)
+        self._cached.pop(result.uuid, None)
+        self._taskids.pop(result.uuid, None)
+        self._fault(host)
+
+        copies = self._copies.get(taskable.uuid, [])
+        if result.uuid in copies: copies.remove(result.uuid)
+        if copies: return
+        self._copies.pop(taskable.uuid, None)
+
+        self._failures[taskable.uuid] += 1
+        failures = self._failures[taskable.uuid]
+        if failures > self._retries:
+            logger.error('%-15s' % 'Abandoning', taskable.uuid, 'after', failures, 'failures')
+            del self._failures[taskable.uuid]
+            self._track(taskable, 'failed')
+            ABANDONED.inc()
+            return
+        delay = self._backoff * 2 ** (failures - 1)
+        logger.info('%-15s' % 'Retrying', taskable.uuid, 'in %.0fs' % delay)
+        heapq.heappush(self._delayed, (time.time() + delay, next(self._order), taskable))
+
+    def _fault(self, host):
+        """
+        Count a failure on worker `host`, blacklisting it after `blacklist` in a row
+        """
+        if not host or not self._blacklist or host in self._blacklisted: return
+        self._faults[host] += 1
+        if self._faults[host] >= self._blacklist:
+            logger.warning('%-15s' % 'Blacklisting', host, 'after', self._faults[host], 'failures')
+            BLACKLISTED.inc()
+            self._blacklisted.add(host)
+            self.wq.blacklist(host)
+
+    def _retry(self):
+        """
+        Submit the failed tasks whose backoff has expired
+        """
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, taskable = heapq.heappop(self._delayed)
+            RETRIES.inc()
+            self.submit(taskable)
+
+    def _submit_ready(self):
+        while True:
+            try:
+                taskable, task = self._ready.get_nowait()
+            except Queue.Empty:
+                break
+            self._submit(taskable, task)
 
     def empty(self):
-        return len(self._table) <= 0
-
-    def wait(self):
-        result = self.wq.wait(self._timeout)
+        return self._source is None \
+            and len(self._table) <= 0 \
+            and self._busy <= 0 \
+            and self._ready.empty() \
+            and self._output.empty() \
+            and not self._delayed \
+            and (self._scheduler is None or len(self._scheduler) <= 0)
+
+    def wait(self, timeout=None):
+        timeout = self._timeout if timeout is None else timeout
+        result = self.wq.wait(timeout)
         if result:
             logger.info1('%-15s' % 'Received', result.uuid)
             taskable = self._table[result.uuid]
-            taskable.update_task(result)
+            problem = self._validate(taskable, result)
+            if problem is not None:
+                self._failed(taskable, result, problem)
+                return None
+            self._failures.pop(taskable.uuid, None)
+            self._faults.pop(result_attr(result, 'hostname'), None)
+            original = self._settle(taskable, result)
+            self._measure(result, original)
+            self._warmed(taskable, result)
             del self._table[result.uuid]
-            self._persist(taskable)
-            return taskable
-
-    def __iter__(self):
-
-        for t in self.upstream:
-            self.submit(t)
+            self._received[taskable.uuid] = time.time()
+            return taskable, result
+
+    def _measure(self, result, original=None):
+        COMPLETED.inc()
+        now = time.time()
+        submitted = self._submitted.pop(result.uuid, None)
+        if submitted is not None:
+            LATENCY.observe(now - submitted)
+            if self._speculation is not None:
+                self._speculation.received(now - submitted, original)
+        runtime = result_attr(result, 'cmd_execution_time')
+        if runtime is not None:
+            RUNTIME.observe(runtime / 1e6) # microseconds
+        transferred = result_attr(result, 'total_bytes_transferred')
+        if transferred is not None:
+            TRANSFERRED.inc(transferred)
+
+    def _warmed(self, taskable, result):
+        """
+        Account for the cached inputs of `result` found on, or transferred to, its worker
+        """
+        cached = self._cached.pop(result.uuid, [])
+        host = result_attr(result, 'hostname')
+        if not host or not self._caching: return
+        self._hosts[taskable.uuid] = host
+        warm = self._warm[host]
+        for remote, size in cached:
+            if remote in warm:
+                CACHE_HITS.inc()
+                CACHE_SAVED.inc(size)
+            else:
+                CACHE_MISSES.inc()
+                warm.add(remote)
+        total = CACHE_HITS.value + CACHE_MISSES.value
+        if total > 0:
+            CACHE_RATE.set(CACHE_HITS.value / float(total))
+
+    def _gauge(self):
+        QUEUE_DEPTH.set(len(self))
+        OUTSTANDING.set(self.outstanding())
+        self._sample_cores()
+
+    def _sample_cores(self):
+        """
+        Accumulate the cores of the workers committed to tasks since the last sample
+        """
+        stats = self.wq.stats
+        total = getattr(stats, 'total_cores', 0)
+        if not total: return
+        committed = getattr(stats, 'committed_cores', 0)
+        UTILIZATION.set(committed / float(total))
+        now = time.time()
+        last, busy, cores = self._utilization
+        if last is not None:
+            self._utilization = [now, busy + committed * (now - last), cores + total * (now - last)]
+        else:
+            self._utilization[0] = now
 
-        while not self.empty():
-            self.wq.replicate()
+    def _handle(self, received):
+        """
+        Update, persist, and process a completed task, yielding the results to pass downstream.
+        When `threaded` this runs on the handler thread, which thereby is
+        the only one to modify and pickle the tasks once they are received.
+        """
+        taskable, result = received
+        taskable.update_task(result)
+        self._track(taskable, 'done')
+        self._persist(taskable)
+        for result in self.process(taskable):
+            if result is None: continue
+            self._flush()
+            yield result
+        self._flush(force=False)
+
+    def _handler(self):
+        """
+        Body of the handler thread when `threaded`
+        """
+        while True:
+            received = self._results.get()
+            if received is None: break
+            try:
+                for result in self._handle(received):
+                    self._output.put((result, None))
+            except Exception:
+                self._output.put((None, sys.exc_info()))
+            finally:
+                with self._busy_lock: self._busy -= 1
+                self._wake.set()
+
+    def _serial(self):
+        while True:
+            self._retry()
+            self._fill()
+            if self.empty(): break
+            self._speculate()
             r = self.wait()
             if r:
-                for result in self.process(r):
-                    if result is None: continue
+                for result in self._handle(r):
+                    yield result
+            self._flush(force=False)
+            self._flush_progress(force=False)
+            self._gauge()
+
+    def _concurrent(self):
+        handler = threading.Thread(target=self._handler, name='mdq-handler')
+        handler.daemon = True
+        handler.start()
+        try:
+            while True:
+                self._wake.clear()
+                self._retry()
+                self._submit_ready()
+                self._fill()
+                while not self._output.empty():
+                    result, error = self._output.get()
+                    if error is not None:
+                        raise error[0], error[1], error[2]
                     yield result
+                if self.empty(): break
+
+                self._speculate()
+                # keep servicing the queue while the handler is busy, returning
+                # promptly once it has output or tasks to submit
+                if self._wake.is_set(): timeout = 0
+                elif self._busy > 0:    timeout = min(self._timeout, POLL)
+                else:                   timeout = None
+                r = self.wait(timeout)
+                if r:
+                    with self._busy_lock: self._busy += 1
+                    self._results.put(r)
+                self._flush_progress(force=False)
+                self._gauge()
+        finally:
+            self._results.put(None)
+            handler.join()
+
+    def __iter__(self):
+
+        try:
+            self._source = iter(self.upstream)
+            loop = self._concurrent if self._threaded else self._serial
+            for result in loop():
+                yield result
+        finally:
+            self._flush()
+            self._flush_progress()
+            if self._speculation is not None:
+                self._speculation.report()
+            if FAILURES.value:
+                logger.info('%-15s' % 'Failures', '%d failed tasks, %d retried, %d abandoned, %d workers blacklisted' % (
+                    FAILURES.value, RETRIES.value, ABANDONED.value, BLACKLISTED.value))
+            count, total = self._turnaround
+            if count > 0:
+                logger.info('%-15s' % 'Turnaround', 'mean %.3fs over %d resubmissions' % (total / count, count))
+            _, busy, cores = self._utilization
+            if cores > 0:
+                logger.info('%-15s' % 'Cores', '%.1f%% of the cores of the workers committed to tasks' % (100 * busy / cores))
+            if CACHE_RATE.value is not None:
+                logger.info('%-15s' % 'Cache', '%.1f%% of cached inputs found on the workers,' % (100 * CACHE_RATE.value),
+                            'avoiding %d bytes' % CACHE_SAVED.value)
 
 class GenerationalWorkQueueStream(WorkQueueStream):
     """
     GenerationalWorkQueueStream :: Persistable t, Extendable t, Taskable t => Stream t -> Stream t
 
-    Run tasks for a given number of generations using the `.extend` method
+    Run tasks for a given number of generations using the `.extend` method.
+    With a `walltime` (seconds), tasks providing an `.adapt` method
+    size each submission to run for about that long, sharing it among
+    chained generations.
+    With a `chain`, tasks providing a `.chain` attribute run up to that
+    many generations per submission.
+    With a `segment` (hours), tasks providing a `.segment` attribute stop
+    after about that long, and tasks whose `.partial` generation stopped
+    early are resubmitted to continue it.
     """
     def __init__(self, *args, **kws):
         gens = kws.pop('generations', 1)
+        walltime = kws.pop('walltime', None)
+        chain = kws.pop('chain', None)
+        segment = kws.pop('segment', None)
         super(GenerationalWorkQueueStream, self).__init__(*args, **kws)
         self._generations = gens
+        self._walltime    = walltime
+        self._chain       = chain
+        self._segment     = segment
         self._count       = collections.defaultdict(lambda:0) # uuid -> int
 
     @property
@@ -162,6 +795,9 @@ class GenerationalWorkQueueStream(WorkQueueStream):
             self._count[task.uuid] = task.generation
             if self._is_submittable(task):
                 logger.info('%-15s' % 'Continuing', task.uuid, 'from generation', self._gen(task))
+                if self._segment and hasattr(task, 'segment'):
+                    task.segment = self._segment
+                self._set_chain(task)
                 yield task
 
     def _gen(self, task):
@@ -171,13 +807,36 @@ class GenerationalWorkQueueStream(WorkQueueStream):
         self._count[task.uuid] += 1
 
     def _is_submittable(self, task):
-        return self._gen(task) < self._generations - 1
+        return self._gen(task) < self._generations - 1 or self._is_partial(task)
+
+    def _is_partial(self, task):
+        return getattr(task, 'partial', False)
+
+    def _set_chain(self, task):
+        """
+        Chain as many generations as allowed, up to the last one
+        """
+        if self._chain and hasattr(task, 'chain'):
+            task.chain = min(self._chain, self._generations - task.generation)
 
     def process(self, task):
-        if self._is_submittable(task):
+        # a chained task may have completed several generations
+        self._count[task.uuid] = task.generation
+        if self._is_partial(task):
+            logger.info('%-15s' % 'Continuing', task.uuid, 'generation', self._gen(task),
+                        'from segment', task.segments)
+            RESUBMISSIONS.inc()
+            self.submit(task)
+            yield None
+        elif self._is_submittable(task):
             logger.info('%-15s' % 'Extending', task.uuid, 'to generation', self._gen(task)+1)
             self._incr(task)
             task.extend()
+            self._set_chain(task)
+            if self._walltime and hasattr(task, 'adapt'):
+                # a chained task runs its generations within the walltime
+                task.adapt(self._walltime / float(getattr(task, 'chain', 1)))
+            RESUBMISSIONS.inc()
             self.submit(task)
             yield None
         else:
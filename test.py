@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+from mdq.executor    import WorkQueueExecutor
 from mdq.persistence import Persistent
 from mdq.stream    import Fount, ResumeTaskStream, GenerationalWorkQueueStream, Sink
 from mdq.workqueue import MkWorkQueue, WorkQueue
@@ -42,6 +43,6 @@ if __name__ == '__main__':
 
     fount     = MockFount()
     persist   = ResumeTaskStream(fount, store)
-    submit    = GenerationalWorkQueueStream(q, persist, timeout=1, persist_to=store, generations=2)
+    submit    = GenerationalWorkQueueStream(WorkQueueExecutor(q), persist, timeout=1, persist_to=store, generations=2)
     sink      = MockSink(submit)
     sink()